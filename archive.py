@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Compressed local archive of the fetched logs.
+
+    Files stay open across intervals and are written in members: gzip
+    members or zstd frames of at most MEMBER_BYTES of text and MEMBER_S
+    seconds of log time. Every finished member is recorded in an index
+    sidecar (<file>.idx) as "offset length min_ts max_ts records", so a
+    time range is read by seeking to the members overlapping it.
+
+    Prepared lines are archived as logstash json_events in
+    <app>-<date>.json files, which replay.py can send again, or as their
+    text in <app>-<date>.log files:
+
+        python archive.py /mnt/gae_logs/app-2013-10-01.json.gz --start 1380610800 --end 1380614400
+"""
+import argparse
+import glob
+import json
+import os
+import os.path as osp
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from record import LogRecord
+
+# file extension of every compression
+EXTENSIONS = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# what is archived of a prepared line: the json_event or the text
+FORMATS = ('events', 'text')
+
+# a member ends after this much text or this many seconds of log time
+MEMBER_BYTES = 4 * 1024 * 1024
+MEMBER_S = 300
+
+# a file is rotated past this size, or this many seconds after it was
+# opened; 0 keeps one file per app and day
+ROTATE_BYTES = 1024 * 1024 * 1024
+ROTATE_S = 0
+
+# files not written for that long are closed
+IDLE_S = 600
+
+BUFFER_SIZE = 1024 * 1024
+
+
+class _Member(object):
+    """Compresses one member, tracking the log time it covers"""
+
+    def __init__(self, compression, offset):
+        self.offset = offset
+        self.size = 0
+        self.records = 0
+        self.min_ts = self.max_ts = None
+        if compression == 'gzip':
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            self._compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self._compressor = None
+
+    def compress(self, timestamp, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if self.min_ts is None or timestamp < self.min_ts:
+            self.min_ts = timestamp
+        if self.max_ts is None or timestamp > self.max_ts:
+            self.max_ts = timestamp
+        self.size += len(text) + 1
+        self.records += 1
+        if self._compressor:
+            return self._compressor.compress(text + '\n')
+        return text + '\n'
+
+    def finish(self):
+        if self._compressor:
+            return self._compressor.flush()
+        return ''
+
+
+class _ArchiveFile(object):
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.opened = time.time()
+        self.written = time.time()
+        self._f = open(path, 'ab', BUFFER_SIZE)
+        self._f.seek(0, os.SEEK_END)
+        self._index = open(path + '.idx', 'a')
+        self._member = None
+
+    def size(self):
+        return self._f.tell()
+
+    def write(self, records):
+        for timestamp, text in records:
+            member = self._member
+            if member is None:
+                member = self._member = _Member(self.compression, self._f.tell())
+            elif member.size >= MEMBER_BYTES or timestamp - member.min_ts >= MEMBER_S:
+                self.finish_member()
+                member = self._member = _Member(self.compression, self._f.tell())
+            self._f.write(member.compress(timestamp, text))
+        self.written = time.time()
+
+    def finish_member(self):
+        """Ends the current member and records it in the index"""
+        member = self._member
+        if member is None:
+            return
+        self._member = None
+        self._f.write(member.finish())
+        self._f.flush()
+        self._index.write('%d %d %s %s %d\n' % (member.offset, self._f.tell() - member.offset,
+                                                 member.min_ts, member.max_ts, member.records))
+        self._index.flush()
+
+    def close(self):
+        self.finish_member()
+        self._f.close()
+        self._index.close()
+
+
+class ArchiveWriter(object):
+    """
+        Writes the lines of every <app>-<date>.<ext> archive to
+        directory, rotated into <app>-<date>.<n>.<ext> files. Processes
+        writing the same directory must each have a suffix, a letter
+        then letters or digits, their files being
+        <app>-<date>.<suffix>[.<n>].<ext>: a file has a single writer.
+    """
+
+    def __init__(self, directory, compression='gzip', rotate_bytes=ROTATE_BYTES, rotate_s=ROTATE_S,
+                 format='events', suffix=None):
+        if compression == 'zstd' and not zstandard:
+            raise ValueError("zstd compression needs the zstandard module")
+        self.directory = directory
+        self.compression = compression
+        self.format = format
+        self.suffix = suffix
+        self.rotate_bytes = rotate_bytes
+        self.rotate_s = rotate_s
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name, seq):
+        base, ext = osp.splitext(name)
+        if self.suffix:
+            base = '%s.%s' % (base, self.suffix)
+        if seq:
+            base = '%s.%d' % (base, seq)
+        return osp.join(self.directory, base + ext + EXTENSIONS[self.compression])
+
+    def _last_seq(self, name):
+        seq = 0
+        while osp.exists(self._path(name, seq + 1)):
+            seq += 1
+        return seq
+
+    def _file(self, name):
+        """Returns the open file of name, rotating it when it is full or old"""
+        f = self._files.get(name)
+        if f and (f.size() >= self.rotate_bytes or
+                  self.rotate_s and time.time() - f.opened >= self.rotate_s):
+            f.close()
+            f = self._files[name] = _ArchiveFile(self._path(name, self._last_seq(name) + 1), self.compression)
+        elif not f:
+            # carry on with the last file of a previous run
+            seq = self._last_seq(name)
+            path = self._path(name, seq)
+            if osp.exists(path) and osp.getsize(path) >= self.rotate_bytes:
+                path = self._path(name, seq + 1)
+            f = self._files[name] = _ArchiveFile(path, self.compression)
+        return f
+
+    def write(self, name, records):
+        """Appends (timestamp, text) records, a line each, to the archive of name"""
+        with self._lock:
+            self._file(name).write(records)
+            for other, f in self._files.items():
+                if time.time() - f.written >= IDLE_S:
+                    f.close()
+                    del self._files[other]
+
+    def write_lines(self, dest, lines):
+        """Archives prepared lines of the <app>-<date>.log destination"""
+        if self.format == 'text':
+            self.write(dest, ((line.end_time, line.line) for line in lines))
+            return
+        self.write(event_name(dest), ((line.end_time, line.raw()) for line in lines))
+
+    def flush(self):
+        """Ends the open members, so everything written so far is indexed"""
+        with self._lock:
+            for f in self._files.values():
+                f.finish_member()
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+
+def event_name(dest):
+    """<app>-<date>.log gives <app>-<date>.json"""
+    return osp.splitext(dest)[0] + '.json'
+
+
+def read_index(path):
+    """Returns the (offset, length, min_ts, max_ts, records) of the members of path"""
+    members = []
+    with open(path + '.idx') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 5:
+                members.append((int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3]), int(fields[4])))
+    return members
+
+
+def _decompress(path, data):
+    if path.endswith(EXTENSIONS['gzip']):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if path.endswith(EXTENSIONS['zstd']):
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def iter_members(path, start=None, end=None):
+    """Yields the text of the indexed members of path overlapping [start, end)"""
+    with open(path, 'rb') as f:
+        for offset, length, min_ts, max_ts, records in read_index(path):
+            if start is not None and max_ts < start or end is not None and min_ts >= end:
+                continue
+            f.seek(offset)
+            yield _decompress(path, f.read(length))
+
+
+def iter_lines(path, start=None, end=None):
+    """Yields the prepared lines of an events archive logged in [start, end)"""
+    for text in iter_members(path, start, end):
+        for event in text.splitlines():
+            event = json.loads(event)
+            timestamp = event['@fields']['timestamp']
+            if start is not None and timestamp < start or end is not None and timestamp >= end:
+                continue
+            yield LogRecord.from_event(event)
+
+
+def archive_files(directory, name):
+    """Returns the files of destination name in directory, oldest first for every writer"""
+    base, ext = osp.splitext(name)
+    pattern = re.compile(r'^%s(\.([a-zA-Z]\w*))?(\.(\d+))?%s(\.gz|\.zst)?$' % (re.escape(base), re.escape(ext)))
+    paths = []
+    for path in glob.glob(osp.join(directory, base + '*')):
+        match = pattern.match(osp.basename(path))
+        if match:
+            paths.append((match.group(2) or '', int(match.group(4) or 0), path))
+    return [path for suffix, seq, path in sorted(paths)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", help="archive file, with its .idx sidecar")
+
+    parser.add_argument("--start", type=float,
+                        help="first log timestamp, default is the start of the file")
+
+    parser.add_argument("--end", type=float,
+                        help="log timestamp to stop at, default is the end of the file")
+
+    args = parser.parse_args()
+    for text in iter_members(args.path, args.start, args.end):
+        sys.stdout.write(text)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#coding=utf8
+"""
+    Backfills a historical range of GAE logs.
+
+    The range is split into shards (one hour by default) that a pool of
+    processes fetches in parallel. Finished and failed shards are recorded
+    in a manifest, so running the same command again only fetches the
+    shards that are missing or failed.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import os.path as osp
+import time
+from datetime import datetime
+
+import fetcher
+
+logger = logging.getLogger()
+
+SHARD_LENGTH = 3600
+
+# fetchers of the current worker process, by app name
+_fetchers = {}
+_options = {}
+
+
+def plan_shards(app_names, start, end, shard_s=SHARD_LENGTH):
+    """Returns (app_name, start, end) shards aligned on shard_s boundaries"""
+    shards = []
+    for app_name in app_names:
+        shard_start = start
+        while shard_start < end:
+            shard_end = min((shard_start / shard_s + 1) * shard_s, end)
+            shards.append((app_name, shard_start, shard_end))
+            shard_start = shard_end
+    return shards
+
+
+def shard_key(shard):
+    return '%s:%s-%s' % shard
+
+
+class Manifest(object):
+    """JSON file recording the outcome of every shard, rewritten atomically"""
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = {}
+        if osp.exists(path):
+            with open(path) as f:
+                self.shards = json.load(f)
+
+    def done(self, shard):
+        return self.shards.get(shard_key(shard), {}).get('status') == 'done'
+
+    def record(self, shard, status, records, seconds, error=None):
+        self.shards[shard_key(shard)] = {'status': status, 'records': records,
+                                         'seconds': round(seconds, 1), 'error': error}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.shards, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+
+def _init_worker(conf, workers, options):
+    app_names, version_ids, redis_namespace, redis_urls, redis_options, es_options, udp_host, udp_port = fetcher.read_config(conf)
+    redis_transports = fetcher.RedisTransports(redis_namespace, redis_urls, hostname='%s.appspot.com' % app_names[0],
+                                               format='raw', logger=logger, es_options=es_options, **redis_options)
+    sinks = fetcher.SinkFanout()
+    # the processes append to files of their own
+    archive = None
+    if options.get('save_to_file'):
+        archive = fetcher.ArchiveWriter(options['save_to_file'], suffix='p%d' % os.getpid())
+    for app_name in app_names:
+        _fetchers[app_name] = fetcher.GAEFetchLog(app_name, redis_namespace, redis_urls, udp_host, udp_port,
+                                                  version_ids=version_ids.get(app_name),
+                                                  redis_transports=redis_transports,
+                                                  sinks=sinks,
+                                                  archive=archive,
+                                                  request_filter=fetcher.read_filters(conf, app_name))
+    # threads of the process, shared by its shards
+    pool = workers > 1 and fetcher.WorkerPool(workers) or None
+    _options.update(options, workers=workers, pool=pool)
+
+
+def run_shard(shard):
+    """Fetches one shard in a worker process, returns (shard, records, seconds, error)"""
+    app_name, start, end = shard
+    gae_fetch_app = _fetchers[app_name]
+    started = time.time()
+    failed = gae_fetch_app.failed
+    try:
+        records = gae_fetch_app.fetch_logs(fetcher.get_time_period(start, end), **_options)
+    except Exception as e:
+        logger.error("Shard %s failed", shard_key(shard), exc_info=True)
+        return shard, 0, time.time() - started, str(e)
+
+    if records is None:
+        return shard, 0, time.time() - started, 'interrupted'
+    if gae_fetch_app.failed > failed:
+        return shard, records, time.time() - started, '%d intervals failed' % (gae_fetch_app.failed - failed)
+    return shard, records, time.time() - started, None
+
+
+def backfill(conf, start, end, manifest_path, processes=4, workers=1, shard_s=SHARD_LENGTH, **options):
+    app_names = fetcher.read_config(conf)[0]
+    manifest = Manifest(manifest_path)
+
+    shards = plan_shards(app_names, start, end, shard_s)
+    todo = [shard for shard in shards if not manifest.done(shard)]
+    logger.info("Backfilling %s - %s: %d shards, %d already done",
+                datetime.fromtimestamp(start, tz=fetcher.GAE_TZ),
+                datetime.fromtimestamp(end, tz=fetcher.GAE_TZ),
+                len(shards), len(shards) - len(todo))
+
+    pool = multiprocessing.Pool(processes, _init_worker, (conf, workers, options))
+    started = time.time()
+    records = failed = finished = 0
+    try:
+        results = pool.imap_unordered(run_shard, todo)
+        while finished < len(todo):
+            # a timeout keeps the wait interruptible
+            shard, shard_records, seconds, error = results.next(timeout=24 * 3600)
+            finished += 1
+            records += shard_records
+            if error:
+                failed += 1
+                manifest.record(shard, 'failed', shard_records, seconds, error)
+            else:
+                manifest.record(shard, 'done', shard_records, seconds)
+
+            elapsed = time.time() - started
+            logger.info("%d/%d shards (%d failed), %d req logs in %ds, %.1f req logs/s",
+                        finished, len(todo), failed, records, elapsed, records / max(elapsed, 1))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return failed
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--start_timestamp", type=int, required=True)
+
+    parser.add_argument("--end_timestamp", type=int, required=True)
+
+    parser.add_argument("--gae_config",
+                        help="Config file for GAE user, pass, app. If not specified, it looks for fetcher.conf")
+
+    parser.add_argument("--manifest",
+                        help="shard manifest, default is backfill-<conf>-<start>-<end>.json")
+
+    parser.add_argument("--processes", type=int, default=4,
+                        help="number of shards fetched in parallel, default is 4")
+
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of intervals fetched concurrently by each process, default is 1")
+
+    parser.add_argument("--shard_length", type=int, default=SHARD_LENGTH,
+                        help="shard length in seconds, default is %d" % SHARD_LENGTH)
+
+    parser.add_argument("--save_to_file",
+                        help="save to file also")
+
+    parser.add_argument("--send_to_es",
+                        help="dir send to es", action='store_true')
+
+    args = parser.parse_args()
+
+    conf = args.gae_config or 'fetcher.conf'
+    manifest_path = args.manifest or 'backfill-%s-%s-%s.json' % (osp.basename(conf), args.start_timestamp, args.end_timestamp)
+
+    failed = backfill(conf, args.start_timestamp, args.end_timestamp, manifest_path,
+                      processes=args.processes, workers=args.workers, shard_s=args.shard_length,
+                      save_to_file=args.save_to_file, send_to_es=args.send_to_es)
+    if failed:
+        logger.error("%d shards failed, run again to retry them", failed)
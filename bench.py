@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+#coding=utf8
+"""
+    Micro-benchmarks of the hot paths:
+
+        python bench.py serializer --records 100000
+        python bench.py timefmt --records 10000 --app_logs 40
+        python bench.py relay --records 20000 --redis_url redis://127.0.0.1:6379
+        python bench.py memory --records 100000
+
+    and of the whole pipeline, from a fake logservice to local stand-ins
+    of redis and ES (see standins.py), a process per pipeline:
+
+        python bench.py pipeline --records 50000 --rate 1000 --fetch_ms 5 --workers 4
+"""
+import argparse
+import copy
+import datetime
+import json
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import redis
+from dateutil import tz
+from elasticsearch import Elasticsearch, helpers
+
+import metrics
+import serializer
+from archive import ArchiveWriter
+from es_sink import ESBulkSink
+from fetch_ec2_log import FetchLog
+from record import LogRecord
+from redis_transport import BaseTransport
+from standins import FETCH_BATCH, FakeLogService, RedisServer, ESServer
+from timefmt import TimeFormatter
+
+
+def sample_line(i, app_logs=5):
+    """A prepared line shaped like GAEFetchLog._prepare_json output used to be"""
+    end_time = 1380585600 + i * 0.01
+    msg = '10.0.0.%d - - [01/Oct/2013:00:00:00 -0700] "GET /api/v1/items/%d HTTP/1.1" 200 1234 - "Mozilla/5.0"' % (i % 255, i)
+    msg = msg + "\n\n" + "\n".join(
+        "2013-10-01T00:00:00.%06d-07:00 INFO handled item %d step %d" % (i % 1000000, i, j) for j in range(app_logs))
+    return {
+        'type': 'agent8-backend-gae',
+        'tags': ['gae'],
+        'timestamp': '2013-10-01T00:00:00-07:00',
+        'line': msg,
+        'fields': {'response': 200, 'latency_ms': 0.042, 'timestamp': end_time, 'environment': 'production'},
+    }
+
+
+def sample_record(i, app_logs=5):
+    """The LogRecord GAEFetchLog._prepare_json returns for sample_line"""
+    line = sample_line(i, app_logs)
+    fields = line['fields']
+    return LogRecord(line['type'], line['timestamp'], line['line'], fields['response'],
+                     fields['latency_ms'], fields['timestamp'], fields['environment'])
+
+
+def _timeit(func, items):
+    started = time.time()
+    for item in items:
+        func(item)
+    return time.time() - started
+
+
+def _report(name, items, legacy, current):
+    print '%-12s legacy %7.2f us/record   now %7.2f us/record   %.2fx' % (
+        name, legacy * 1e6 / len(items), current * 1e6 / len(items), legacy / current)
+
+
+def bench_serializer(args):
+    transport = BaseTransport('bench', 'raw')
+    lines = [sample_line(i, args.app_logs) for i in range(args.records)]
+    records = [sample_record(i, args.app_logs) for i in range(args.records)]
+
+    # redis: raw format for RPUSH
+    _report('redis', lines,
+            _timeit(lambda line: transport.format('f', **line), lines),
+            _timeit(lambda record: record.raw(), records))
+
+    # es: _source of the bulk action, which the ES sink encodes
+    _report('es', lines,
+            _timeit(lambda line: serializer.fast_dumps(json.loads(transport.format('f', **line))), lines),
+            _timeit(lambda record: record.source(), records))
+
+    # udp: logcenter format, which used to need a deepcopy of every line
+    _report('udp', lines,
+            _timeit(lambda line: transport.format('f', format='logcenter', **copy.deepcopy(line)), lines),
+            _timeit(lambda record: record.logcenter(), records))
+
+
+def _in_child(func, *args):
+    """Returns func(*args), called in a forked child so that its memory and metrics are its own"""
+    r, w = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(r)
+        try:
+            os.write(w, json.dumps(func(*args)))
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _build(build, records, app_logs):
+    before = _peak_rss_kb()
+    items = [build(i, app_logs) for i in range(records)]
+    return _peak_rss_kb() - before
+
+
+def _peak_rss(build, records, app_logs):
+    """KB of peak RSS added by holding build(i, app_logs) for records, measured in a child"""
+    return _in_child(_build, build, records, app_logs)
+
+
+def bench_memory(args):
+    # an interval of prepared lines, as dicts then as LogRecords
+    legacy = _peak_rss(sample_line, args.records, args.app_logs)
+    current = _peak_rss(sample_record, args.records, args.app_logs)
+    print 'memory       legacy %7.1f MB peak   now %7.1f MB peak   %.2fx   (%d records)' % (
+        legacy / 1024.0, current / 1024.0, legacy / float(max(current, 1)), args.records)
+
+
+def _legacy_level(level):
+    if 0 == level:
+        return "DEBUG"
+    if 1 == level:
+        return "INFO"
+    if 2 == level:
+        return "WARNING"
+    if 3 == level:
+        return "ERROR"
+    if 4 == level:
+        return "CRITICAL"
+    return "UNKNOWN"
+
+
+def bench_timefmt(args):
+    gae_tz = tz.gettz('US/Pacific')
+    times = TimeFormatter(gae_tz)
+    levels = {0: "DEBUG", 1: "INFO", 2: "WARNING", 3: "ERROR", 4: "CRITICAL"}
+
+    # app logs of a request are written within its latency, mostly at INFO
+    requests = []
+    for i in range(args.records):
+        end_time = 1380585600 + i * 0.01
+        requests.append((end_time, [(end_time - 0.05 + j * 0.001, j % 5 and 1 or 3, 'step %d' % j)
+                                    for j in range(args.app_logs)]))
+
+    def legacy(request):
+        end_time, app_logs = request
+        datetime.datetime.fromtimestamp(end_time).replace(tzinfo=gae_tz).isoformat()
+        for t, level, message in app_logs:
+            t = datetime.datetime.fromtimestamp(t).replace(tzinfo=gae_tz)
+            "%s %s %s" % (t.isoformat(), _legacy_level(level), message)
+        log_time = datetime.datetime.fromtimestamp(end_time)
+        log_time.strftime('%Y-%m-%d'), '%02d' % log_time.hour
+
+    def current(request):
+        end_time, app_logs = request
+        times.isoformat(end_time)
+        for t, level, message in app_logs:
+            "%s %s %s" % (times.isoformat(t), levels.get(level, "UNKNOWN"), message)
+        times.date_hour(end_time)
+
+    _report('timefmt', requests, _timeit(legacy, requests), _timeit(current, requests))
+
+
+def bench_relay(args):
+    key = 'bench_relay'
+    if not args.redis_url:
+        args.redis_url = RedisServer().url
+    r = redis.StrictRedis.from_url(args.redis_url)
+    msgs = [sample_record(i, args.app_logs).logcenter() for i in range(args.records)]
+
+    def fill():
+        r.delete(key)
+        for i in range(0, len(msgs), 1000):
+            r.rpush(key, *msgs[i:i + 1000])
+
+    es = Elasticsearch([ESServer().url], serializer=serializer.ESSerializer())
+
+    # one BRPOP and one bulk request per message
+    fill()
+    started = time.time()
+    for _ in msgs:
+        log_data = json.loads(r.brpop(key, 1)[1])
+        index_name = log_data['@fields']['date'][0].replace('-', '.')
+        helpers.bulk(es, [{'_index': 'logstash-%s' % index_name, '_type': 'bench', '_source': log_data}])
+    legacy = time.time() - started
+
+    relay = FetchLog(args.redis_url, key, es=es)
+    fill()
+    started = time.time()
+    consumed = 0
+    while consumed < len(msgs):
+        consumed += relay.consume_batch()
+    relay.es_sink.flush()
+    current = time.time() - started
+    r.delete(key)
+
+    print 'relay        legacy %7.0f docs/s     now %7.0f docs/s     %.2fx' % (
+        len(msgs) / legacy, len(msgs) / current, legacy / current)
+
+
+# app of the pipeline benchmark, it needs an environment
+PIPELINE_APP = 'agent8-backend'
+
+# the pipelines of the pipeline benchmark, udp and archive send to redis too
+PIPELINES = ('redis', 'es', 'udp', 'archive', 'relay')
+
+# redis list of the pipeline benchmark
+PIPELINE_KEY = 'bench_pipeline'
+
+
+def _local_session(app_name, service):
+    """A RemoteApiSession fetching from service instead of remote_api"""
+    from remote_api_session import RemoteApiSession
+
+    class LocalSession(RemoteApiSession):
+
+        def ensure(self):
+            pass
+
+        def _fetch(self, **kwargs):
+            return service.fetch(**kwargs)
+
+    return LocalSession(app_name)
+
+
+def _fetch(pipeline, args, redis_url, es_url):
+    """Fetches args.records req logs through fetcher.py to the stand-ins"""
+    # needs the GAE SDK, which the other benchmarks do without
+    import fetcher
+    redis_transports = fetcher.RedisTransports(PIPELINE_KEY, [redis_url], 'bench', format='raw',
+                                               logger=logging.getLogger(), es_options={'hosts': [es_url]})
+    directory = tempfile.mkdtemp()
+    archive = None
+    if pipeline == 'archive':
+        archive = ArchiveWriter(directory)
+    gae = fetcher.GAEFetchLog(PIPELINE_APP, PIPELINE_KEY, [redis_url], '127.0.0.1', args.udp_port,
+                              redis_transports=redis_transports, archive=archive)
+    gae.session = _local_session(PIPELINE_APP, FakeLogService(args.rate, args.app_logs,
+                                                              args.message_bytes, args.fetch_ms))
+    start = 1380585600
+    try:
+        return gae.fetch_logs(fetcher.get_time_period(start, start + args.records // args.rate),
+                              save_to_file=archive and directory, send_to_es=pipeline == 'es',
+                              send_to_udp=pipeline == 'udp', workers=args.workers)
+    finally:
+        shutil.rmtree(directory)
+
+
+def _relay(args, redis_url, es_url):
+    """Relays args.records logcenter events from redis to ES with fetch_ec2_log.py"""
+    r = redis.StrictRedis.from_url(redis_url)
+    for i in range(0, args.records, 1000):
+        r.rpush(PIPELINE_KEY, *[sample_record(j, args.app_logs).logcenter()
+                                for j in range(i, min(i + 1000, args.records))])
+    relay = FetchLog(redis_url, PIPELINE_KEY, es_sink=ESBulkSink(hosts=[es_url]))
+    started = time.time()
+    consumed = 0
+    while consumed < args.records:
+        consumed += relay.consume_batch()
+    relay.es_sink.flush()
+    return consumed, time.time() - started
+
+
+def _run_pipeline(pipeline, args, redis_url, es_url):
+    started = time.time()
+    if pipeline == 'relay':
+        records, seconds = _relay(args, redis_url, es_url)
+    else:
+        records = _fetch(pipeline, args, redis_url, es_url)
+        seconds = time.time() - started
+    redis.StrictRedis.from_url(redis_url).delete(PIPELINE_KEY)
+
+    stages = {}
+    for key, counts in metrics.REGISTRY.get('stage_seconds').items():
+        stage = dict(key)['stage']
+        count, total = stages.get(stage, (0, 0.0))
+        stages[stage] = (count + sum(counts[:-1]), total + counts[-1])
+    return {'records': records, 'seconds': seconds, 'peak_kb': _peak_rss_kb(), 'stages': stages}
+
+
+def bench_pipeline(args):
+    redis_url = args.redis_url or RedisServer().url
+    es = ESServer(reject_rate=args.reject_rate)
+    for pipeline in args.pipelines.split(','):
+        result = _in_child(_run_pipeline, pipeline, args, redis_url, es.url)
+        stages = '  '.join('%s %.1fms' % (stage, total * 1e3 / count)
+                           for stage, (count, total) in sorted(result['stages'].items()) if count)
+        print '%-8s %8.0f records/s  %7.1f MB peak   %s' % (
+            pipeline, result['records'] / result['seconds'], result['peak_kb'] / 1024.0, stages)
+
+
+BENCHMARKS = {
+    'memory': bench_memory,
+    'pipeline': bench_pipeline,
+    'relay': bench_relay,
+    'serializer': bench_serializer,
+    'timefmt': bench_timefmt,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+
+    parser.add_argument("--records", type=int, default=100000,
+                        help="records per run, default is 100000")
+
+    parser.add_argument("--app_logs", type=int, default=5,
+                        help="app log lines per request log, default is 5")
+
+    parser.add_argument("--redis_url",
+                        help="redis used by the relay and pipeline benchmarks, default is a local stand-in")
+
+    parser.add_argument("--rate", type=int, default=1000,
+                        help="req logs per second of log time the fake logservice generates, default is 1000")
+
+    parser.add_argument("--message_bytes", type=int, default=200,
+                        help="size of the combined line of a fake req log, default is 200")
+
+    parser.add_argument("--fetch_ms", type=float, default=0,
+                        help="ms a logservice round trip of %d req logs takes, default is 0" % FETCH_BATCH)
+
+    parser.add_argument("--workers", type=int, default=1,
+                        help="intervals fetched concurrently by the pipeline benchmark, default is 1")
+
+    parser.add_argument("--pipelines", default=','.join(PIPELINES),
+                        help="comma separated pipelines to run, default is %s" % ','.join(PIPELINES))
+
+    parser.add_argument("--reject_rate", type=float, default=0,
+                        help="share of the docs the ES stand-in rejects with 429, default is 0")
+
+    parser.add_argument("--udp_port", type=int, default=5140,
+                        help="local port the udp pipeline sends to, default is 5140")
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import errno
+import fcntl
+import json
+import os
+import os.path as osp
+import sys
+import threading
+import time
+from datetime import datetime
+
+# shared by every fetcher on the host
+CHECKPOINTS = '/var/tmp/gae_log_fetcher.checkpoints'
+
+# seconds between two writes of the store
+FLUSH_INTERVAL = 5
+
+
+def checkpoint_key(app_name, version_ids):
+    return '%s:%s' % (app_name, ','.join(version_ids))
+
+
+class CheckpointStore(object):
+    """
+        Keeps the recovery state of several apps and versions in one JSON
+        file. Updates are batched in memory and written at most every
+        flush_interval seconds by renaming a fsynced temporary file over
+        the store, so a crash leaves either the old or the new state.
+        Processes sharing the store take a lock and only write back the
+        keys they updated.
+    """
+
+    def __init__(self, path=CHECKPOINTS, flush_interval=FLUSH_INTERVAL, before_flush=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        # called before writing, e.g. to wait for asynchronous sinks
+        self.before_flush = before_flush
+        self._dirty = set()
+        self._flushed = 0
+        self._lock = threading.Lock()
+        self._state = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+
+    def get(self, key):
+        with self._lock:
+            return self._state.get(key)
+
+    def set(self, key, timestamp, end=None, offset=None):
+        """Records where key resumes, see GAEFetchLog._save_checkpoint"""
+        with self._lock:
+            self._state[key] = {'timestamp': timestamp, 'end': end, 'offset': offset,
+                                'updated': int(time.time())}
+            self._dirty.add(key)
+            due = time.time() - self._flushed >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            updates = dict((key, self._state[key]) for key in self._dirty)
+            self._dirty.clear()
+            self._flushed = time.time()
+
+        try:
+            # everything delivered before these updates were set must be
+            # out of the sinks before they are written
+            if self.before_flush:
+                self.before_flush()
+
+            with open(self.path + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    state = self.load()
+                    state.update(updates)
+                    self._write(state)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except:
+            with self._lock:
+                for key, value in updates.iteritems():
+                    if key not in self._dirty:
+                        self._state[key] = value
+                        self._dirty.add(key)
+            raise
+
+        with self._lock:
+            for key, value in state.iteritems():
+                if key not in self._dirty:
+                    self._state[key] = value
+
+    def _write(self, state):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+        fd = os.open(osp.dirname(osp.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.flush()
+
+
+def print_status(path):
+    state = CheckpointStore(path).load()
+    now = time.time()
+    print '%-40s %-26s %8s %-19s %s' % ('app:versions', 'resume from', 'lag (s)', 'updated', 'offset')
+    for key in sorted(state):
+        entry = state[key]
+        print '%-40s %-26s %8d %-19s %s' % (
+            key,
+            datetime.fromtimestamp(entry['timestamp']).isoformat(),
+            now - entry['timestamp'],
+            datetime.fromtimestamp(entry['updated']).strftime('%Y-%m-%d %H:%M:%S'),
+            entry['offset'] or '-')
+
+
+if __name__ == '__main__':
+    print_status(len(sys.argv) > 1 and sys.argv[1] or CHECKPOINTS)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+    fetcher.conf and the settings shared by the tools around fetcher.py,
+    importable without the GAE SDK (replay.py, relay.py).
+"""
+import ConfigParser
+
+from dateutil import tz
+
+# upper bounds of a chunk of prepared lines held in memory before it is
+# flushed to the sinks
+MAX_BUFFER_RECORDS = 1000
+MAX_BUFFER_BYTES = 8 * 1024 * 1024
+
+# seconds between two progress reports of a multi-app fetch
+STATUS_INTERVAL = 60
+
+GAE_TZ = tz.gettz('US/Pacific')
+
+
+def read_config(conf):
+    """
+        Reads a fetcher.conf and returns (app_names, version_ids,
+        redis_namespace, redis_urls, redis_options, es_options,
+        udp_host, udp_port)
+    """
+    config = ConfigParser.SafeConfigParser()
+    config.read(conf)
+
+    # app_name may list several apps, version_ids.<app> overrides version_ids
+    app_names = [x.strip() for x in config.get('GAE', 'app_name').split(',')]
+    version_ids = {}
+    for app_name in app_names:
+        for option in ('version_ids.%s' % app_name, 'version_ids'):
+            if config.has_option('GAE', option):
+                version_ids[app_name] = [x.strip() for x in config.get('GAE', option).split(',')]
+                break
+
+    redis_urls = config.get('REDIS', 'redis_urls')
+    redis_namespace = config.get('REDIS', 'namespace')
+    udp_host = config.get('UDP', 'host')
+    udp_port = int(config.get('UDP', 'port'))
+
+    redis_urls = redis_urls.split(',')
+
+    # optional batching and back-pressure settings of RedisTransport
+    redis_options = {}
+    for option in ('rpush_max_count', 'rpush_max_bytes', 'max_in_flight', 'high_water'):
+        if config.has_option('REDIS', option):
+            redis_options[option] = config.getint('REDIS', option)
+
+    # optional [ES] section, settings of the ESBulkSink
+    es_options = {}
+    if config.has_section('ES'):
+        for option, value in config.items('ES'):
+            if option == 'hosts':
+                es_options[option] = [x.strip() for x in value.split(',')]
+            else:
+                es_options[option] = int(value)
+
+    return app_names, version_ids, redis_namespace, redis_urls, redis_options, es_options, udp_host, udp_port
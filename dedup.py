@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+    Drops the req logs a fetcher already sent.
+
+    Every req log has an id derived from its GAE request id and end time,
+    the same whenever it is fetched again. It is the _id of its ES
+    document, so ES overwrites instead of adding a copy, and SeenSet
+    remembers the ids sent lately so that re-fetched intervals do not
+    push copies to redis either. Ids are only remembered once every sink
+    sent their req log, one lost to a failed sink is sent again.
+"""
+import hashlib
+import math
+import struct
+import threading
+
+# ids remembered per bucket before it grows another filter
+CAPACITY = 1000000
+
+# chance that an unseen id is taken for a sent one
+ERROR_RATE = 1e-6
+
+# seconds of log time per bucket, and buckets kept
+BUCKET_S = 3600
+BUCKETS = 6
+
+
+def event_id(request_id, end_time):
+    """The id of a req log, request ids alone repeat for incomplete requests"""
+    return '%s-%d' % (request_id, int(round(end_time * 1e6)))
+
+
+class BloomFilter(object):
+    """A Bloom filter of capacity ids with a false positive rate of error_rate"""
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.count = 0
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        # two hashes make all of them (Kirsch and Mitzenmacher)
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        array = self._array
+        return all(array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        array = self._array
+        for p in self._positions(key):
+            array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class SeenSet(object):
+    """
+        The ids of the req logs sent lately, in Bloom filters bucketed by
+        log time. Only the newest buckets are kept: req logs older than
+        them are never taken for sent ones. A bucket holding more than
+        capacity ids grows another filter rather than losing accuracy.
+    """
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE, bucket_s=BUCKET_S, buckets=BUCKETS):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bucket_s = bucket_s
+        self.buckets = buckets
+        self.dropped = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, timestamp):
+        """Returns the filters of the bucket of timestamp, None when it is too old to keep"""
+        key = int(timestamp // self.bucket_s)
+        filters = self._buckets.get(key)
+        if filters is None:
+            if len(self._buckets) >= self.buckets and key < min(self._buckets):
+                return None
+            filters = self._buckets[key] = [BloomFilter(self.capacity, self.error_rate)]
+            while len(self._buckets) > self.buckets:
+                del self._buckets[min(self._buckets)]
+        return filters
+
+    def _seen(self, id, timestamp):
+        filters = self._buckets.get(int(timestamp // self.bucket_s))
+        return bool(filters) and any(id in f for f in filters)
+
+    def add(self, id, timestamp):
+        """Remembers id and returns whether it was seen already"""
+        with self._lock:
+            filters = self._bucket(timestamp)
+            if filters is None:
+                return False
+            if any(id in f for f in filters):
+                return True
+            if filters[-1].count >= self.capacity:
+                filters.append(BloomFilter(self.capacity, self.error_rate))
+            filters[-1].add(id)
+            return False
+
+    def filter(self, records):
+        """Returns the records whose id was not seen, without remembering them"""
+        with self._lock:
+            unseen = [record for record in records if not record.id or not self._seen(record.id, record.end_time)]
+            self.dropped += len(records) - len(unseen)
+        return unseen
+
+    def update(self, records):
+        """Remembers the ids of records, once they were sent"""
+        for record in records:
+            if record.id:
+                self.add(record.id, record.end_time)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'filters': sum(len(filters) for filters in self._buckets.values()),
+                'bytes': sum(len(f._array) for filters in self._buckets.values() for f in filters),
+                'dropped': self.dropped,
+            }
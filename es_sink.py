@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import logging
+import Queue
+import random
+import threading
+import time
+
+from elasticsearch import Elasticsearch
+
+import metrics
+import serializer
+
+logger = logging.getLogger()
+
+# limits of a single bulk request
+MAX_CHUNK_BYTES = 5 * 1024 * 1024
+MAX_CHUNK_DOCS = 1000
+
+# rejected items are retried after BACKOFF * 2 ** attempt seconds (+/- 50%)
+MAX_RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# statuses worth retrying, the cluster is overloaded or recovering
+RETRY_STATUSES = (429, 503)
+
+STATS_INTERVAL = 60
+
+
+class _Batch(object):
+    """
+        Actions put together, done(indexed, dropped, failed) is called
+        once all are handled, with the encoded _source of the ones ES
+        refused (dropped) and the number of those it could not take at
+        all, being unreachable or overloaded (failed)
+    """
+
+    def __init__(self, size, done):
+        self.pending = size
+        self.indexed = 0
+        self.dropped = []
+        self.failed = 0
+        self.done = done
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def handled(self, outcome, line):
+        with self.lock:
+            if outcome == 'indexed':
+                self.indexed += 1
+            elif outcome == 'dropped':
+                self.dropped.append(line.split('\n', 2)[1])
+            else:
+                self.failed += 1
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            if self.done:
+                self.done(self.indexed, self.dropped, self.failed)
+            self.finished.set()
+
+
+class ESBulkSink(object):
+    """
+        Indexes actions in the background. A bounded queue feeds worker
+        threads sending bulk requests of at most max_chunk_bytes; the
+        items Elasticsearch rejects with 429/503 are retried alone, with
+        jittered exponential back-off.
+
+        Items which still fail, and the chunks of bulk requests which
+        fail max_retries times, are failed rather than dropped, and down
+        is set until a bulk request succeeds again.
+    """
+
+    def __init__(self, es=None, hosts=None, workers=2, queue_size=10000,
+                 max_chunk_bytes=MAX_CHUNK_BYTES, max_chunk_docs=MAX_CHUNK_DOCS,
+                 max_retries=MAX_RETRIES, request_timeout=90):
+        self.es = es or Elasticsearch(hosts, serializer=serializer.ESSerializer())
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_chunk_docs = max_chunk_docs
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+        self._queue = Queue.Queue(queue_size)
+        self._batches = set()
+        self._lock = threading.Lock()
+        self._stats = {'indexed': 0, 'dropped': 0, 'failed': 0, 'retried': 0, 'requests': 0, 'bytes': 0,
+                       'seconds': 0.0}
+        self._stats_logged = time.time()
+        self._last_indexed = 0
+        self._dumps = serializer.fast_dumps
+        self.down = threading.Event()
+        metrics.collect(lambda: metrics.set_gauge('queue_depth', self._queue.qsize(), queue='es_sink'))
+
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def put_many(self, actions, done=None):
+        """
+            Queues bulk actions (dicts with _index, _type, _source and
+            optionally _id), blocking while the queue is full
+        """
+        if not actions:
+            if done:
+                done(0, [], 0)
+            return
+        batch = _Batch(len(actions), done)
+        with self._lock:
+            self._batches.add(batch)
+        for action in actions:
+            self._queue.put((self._encode(action), batch))
+
+    def flush(self):
+        """
+            Waits until the actions queued so far have been indexed or
+            dropped, while other threads may keep queueing
+        """
+        with self._lock:
+            batches = list(self._batches)
+        for batch in batches:
+            batch.finished.wait()
+
+    def _encode(self, action):
+        meta = {'_index': action['_index'], '_type': action['_type']}
+        if action.get('_id'):
+            meta['_id'] = action['_id']
+        source = action['_source']
+        if not isinstance(source, basestring):
+            source = self._dumps(source)
+        return '%s\n%s\n' % (self._dumps({'index': meta}), source)
+
+    def _next_chunk(self):
+        """
+            Blocks for a first action, then takes the queued ones until a
+            limit is hit; a partial chunk is sent as soon as the queue
+            drains, actions queued meanwhile make the next one
+        """
+        chunk = [self._queue.get()]
+        size = len(chunk[0][0])
+        while len(chunk) < self.max_chunk_docs and size < self.max_chunk_bytes:
+            try:
+                item = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            chunk.append(item)
+            size += len(item[0])
+        return chunk
+
+    def _work(self):
+        while True:
+            chunk = self._next_chunk()
+            try:
+                self._send(chunk)
+            except Exception:
+                logger.error("ES unavailable, %d docs failed", len(chunk), exc_info=True)
+                self.down.set()
+                self._finish(chunk, 'failed')
+            self._log_stats()
+
+    def _send(self, chunk):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                delay = min(MAX_BACKOFF, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.5)
+                self._add('retried', len(chunk))
+                time.sleep(delay)
+
+            body = ''.join(line for line, batch in chunk)
+            started = time.time()
+            try:
+                response = self.es.bulk(body=body, params={'request_timeout': self.request_timeout})
+            except Exception as e:
+                metrics.inc('errors_total', stage='es', type=e.__class__.__name__)
+                if attempt < self.max_retries:
+                    logger.warning("Bulk of %d docs failed (%s), retrying", len(chunk), e)
+                    continue
+                raise
+            finally:
+                self._add('requests', 1)
+                self._add('bytes', len(body))
+                self._add('seconds', time.time() - started)
+                metrics.observe('stage_seconds', time.time() - started, stage='es')
+                metrics.inc('bytes_total', len(body), stage='es')
+            self.down.clear()
+
+            rejected = []
+            for item, result in zip(chunk, response['items']):
+                result = result.values()[0]
+                status = result.get('status', 200)
+                if status >= 300:
+                    metrics.inc('errors_total', stage='es', type=str(status))
+                if status in RETRY_STATUSES:
+                    rejected.append(item)
+                elif status >= 300:
+                    logger.error("Dropped doc for %s: %s", result.get('_index'), result.get('error'))
+                    self._finish([item], 'dropped')
+                else:
+                    self._finish([item], 'indexed')
+
+            if not rejected:
+                return
+            logger.info("%d of %d docs rejected, retrying them", len(rejected), len(chunk))
+            chunk = rejected
+
+        logger.error("%d docs still rejected after %d retries", len(chunk), self.max_retries)
+        self._finish(chunk, 'failed')
+
+    def _finish(self, items, outcome):
+        """Hands items back to their batches, outcome is indexed, dropped or failed"""
+        self._add(outcome, len(items))
+        if outcome == 'indexed':
+            metrics.inc('records_total', len(items), stage='es')
+        for line, batch in items:
+            batch.handled(outcome, line)
+            if batch.finished.is_set():
+                with self._lock:
+                    self._batches.discard(batch)
+
+    def _add(self, key, value):
+        with self._lock:
+            self._stats[key] += value
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+    def _log_stats(self):
+        with self._lock:
+            if time.time() - self._stats_logged < STATS_INTERVAL:
+                return
+            elapsed = time.time() - self._stats_logged
+            self._stats_logged = time.time()
+        stats = self.stats()
+        stats['rate'] = (stats['indexed'] - self._last_indexed) / elapsed
+        self._last_indexed = stats['indexed']
+        logger.info("es: %(indexed)d docs indexed (%(rate).1f docs/s), %(dropped)d dropped, %(failed)d failed, "
+                    "%(retried)d retried, %(requests)d bulk requests, %(queued)d queued" % stats)
@@ -2,6 +2,11 @@
 #coding=utf8
 
 import time
+import argparse
+import collections
+import functools
+import os
+import threading
 
 import logging
 
@@ -9,7 +14,10 @@ import simplejson as json
 
 
 from elasticsearch import Elasticsearch
-from elasticsearch import helpers
+
+import metrics
+import serializer
+from es_sink import ESBulkSink
 
 import socket
 socket.setdefaulttimeout(30)
@@ -18,49 +26,323 @@ import redis
 
 logger = logging.getLogger()
 
+QUEUE_KEY = 'ec2_easilydo_log'
+
+# messages taken from redis per cycle, and how long a cycle may wait for them
+BATCH_SIZE = 500
+MAX_WAIT = 1.0
+
+# reliable workers refresh their heartbeat every HEARTBEAT_TTL / 3 seconds,
+# the processing list of a worker without heartbeat is requeued
+HEARTBEAT_TTL = 60
+
+# seconds between two pings of ES while it is down
+ES_DOWN_WAIT = 5
+
+
+class _Pending(object):
+    """Messages moved to the processing list together, acknowledged in order"""
+
+    def __init__(self, msgs, groups):
+        self.msgs = msgs
+        self.groups = groups
+        self.dropped = []
+        self.failed = 0
+        self.done = False
+
+
+def _index_name(log_data):
+    """Date part of the index, taken from the timestamp when there is no date field"""
+    date = log_data['@fields'].get('date')
+    if date:
+        return date[0].replace('-', '.')
+    return log_data['@timestamp'][:10].replace('-', '.')
+
 
 class FetchLog(object):
 
-    def __init__(self):
-        self.es = Elasticsearch()
+    def __init__(self, redis_url='redis://127.0.0.1', key=QUEUE_KEY,
+                 batch_size=BATCH_SIZE, max_wait=MAX_WAIT, es=None,
+                 reliable=False, worker_id=None, es_sink=None):
+        """
+            A reliable relay moves messages to its own processing list
+            and removes them once ES has handled them, so a crash loses
+            nothing: messages are at worst indexed twice. The documents
+            ES refused, and the messages which are not json, are moved
+            to the <key>:failed list. While ES is down the relay stops
+            taking messages, the ones ES could not take are requeued
+            once it is back.
+        """
+        if es_sink:
+            es = es or es_sink.es
+        self.es = es or Elasticsearch(serializer=serializer.ESSerializer())
+        self.es_sink = es_sink or ESBulkSink(self.es)
+        self.redis_url = redis_url
+        self.key = key
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._redis = redis.StrictRedis.from_url(redis_url)
+
+        self.reliable = reliable
+        self.worker_id = worker_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.processing_key = self._processing_key(self.worker_id)
+        self.failed_key = '%s:failed' % key
+        self._pending = collections.deque()
+        self._ack_lock = threading.Lock()
+        self._stopped = threading.Event()
+        # set by _done once ES failed on a batch of this relay
+        self._es_failed = threading.Event()
+        self.consumed = 0
+
+    def _processing_key(self, worker_id):
+        return '%s:processing:%s' % (self.key, worker_id)
+
+    def _alive_key(self, worker_id):
+        return '%s:alive:%s' % (self.key, worker_id)
 
-    def send_to_es(self, index_name, lines, **kwargs):
+    def send_to_es(self, index_name, lines, done=None, **kwargs):
         actions = []
         for msg in lines:
+            # the events of RedisTransport have no component
+            component = msg['@fields'].get('component')
             action = {
                 "_index": "logstash-%s" % index_name,
-                "_type": msg['@fields']['component'][0] + '-' + msg['@type'],
+                "_type": component and component[0] + '-' + msg['@type'] or msg['@type'],
                 #"_version": "1",
                 "_source": msg
             }
+            # set by fetchers since dedup, re-sent events overwrite their document
+            if msg['@fields'].get('event_id'):
+                action['_id'] = msg['@fields']['event_id']
 
             actions.append(action)
         logging.info("save to es[index_name: %s, type: %s, actions: %s]", action['_index'], action['_type'], len(actions))
 
-        helpers.bulk(self.es, actions, chunk_size=100, params={'request_timeout': 90})
+        self.es_sink.put_many(actions, done)
 
-    def run(self):
-        lines = []
-        self._redis = redis.Redis(host='127.0.0.1')
+    def _pop_batch(self):
+        """
+            Blocks up to a second for one message, then drains up to
+            batch_size messages in all without blocking, for at most
+            max_wait seconds
+        """
+        if self.reliable:
+            return self._move_batch()
+
+        popped = self._redis.brpop(self.key, 1)
+        if not popped:
+            return []
+
+        msgs = [popped[1]]
+        deadline = time.time() + self.max_wait
+        while len(msgs) < self.batch_size and time.time() < deadline:
+            n = self.batch_size - len(msgs)
+            # BRPOP takes from the tail, so drain the tail too, atomically
+            pipe = self._redis.pipeline()
+            pipe.lrange(self.key, -n, -1)
+            pipe.ltrim(self.key, 0, -n - 1)
+            drained = pipe.execute()[0]
+            msgs.extend(reversed(drained))
+            if len(drained) < n:
+                break
+        return msgs
+
+    def _move_batch(self):
+        """Like _pop_batch, moving each message to the processing list atomically"""
+        popped = self._redis.brpoplpush(self.key, self.processing_key, 1)
+        if popped is None:
+            return []
+
+        msgs = [popped]
+        deadline = time.time() + self.max_wait
+        while len(msgs) < self.batch_size and time.time() < deadline:
+            n = self.batch_size - len(msgs)
+            pipe = self._redis.pipeline(transaction=False)
+            for _ in range(n):
+                pipe.rpoplpush(self.key, self.processing_key)
+            drained = [msg for msg in pipe.execute() if msg is not None]
+            msgs.extend(drained)
+            if len(drained) < n:
+                break
+        return msgs
+
+    def _done(self, pending, indexed, dropped, failed):
+        """
+            Called by the ES sink for every index group. Batches are
+            acknowledged in the order they were moved: the processing
+            list holds the oldest messages at its tail, which is trimmed.
+            A batch ES failed on stays unacknowledged, along with the
+            ones behind it, until _recover requeues them.
+        """
+        with self._ack_lock:
+            pending.groups -= 1
+            pending.dropped.extend(dropped)
+            pending.failed += failed
+            if pending.groups > 0:
+                return
+            pending.done = True
+            if pending.failed:
+                logging.error("ES failed on %d of %d docs, leaving them in %s",
+                              pending.failed, len(pending.msgs), self.processing_key)
+                self._es_failed.set()
+
+            acked = []
+            while self._pending and self._pending[0].done and not self._pending[0].failed:
+                acked.append(self._pending.popleft())
+            if not acked:
+                return
+
+            try:
+                pipe = self._redis.pipeline()
+                for batch in acked:
+                    if batch.dropped:
+                        logging.error("%d of %d docs dropped by ES, moving them to %s",
+                                      len(batch.dropped), len(batch.msgs), self.failed_key)
+                        pipe.rpush(self.failed_key, *batch.dropped)
+                pipe.ltrim(self.processing_key, 0, -sum(len(batch.msgs) for batch in acked) - 1)
+                pipe.execute()
+            except Exception as e:
+                # left in the processing list, they are requeued with it
+                logging.error("ack of %d batches failed: %s", len(acked), e)
+
+    def _heartbeat(self):
         while True:
             try:
-                key, log_data = self._redis.brpop('ec2_easilydo_log', 0)
-                if not log_data:
-                    logging.info("not log in queue, sleep 1")
-                    time.sleep(1)
-                    continue
+                self._redis.setex(self._alive_key(self.worker_id), HEARTBEAT_TTL, 1)
+            except Exception as e:
+                logging.error("heartbeat of %s failed: %s", self.worker_id, e)
+            time.sleep(HEARTBEAT_TTL / 3)
+
+    def start_heartbeat(self):
+        self._redis.setex(self._alive_key(self.worker_id), HEARTBEAT_TTL, 1)
+        t = threading.Thread(target=self._heartbeat)
+        t.daemon = True
+        t.start()
 
-                log_data = json.loads(log_data)
+    def reclaim(self):
+        """
+            Requeues the processing lists of workers whose heartbeat
+            expired, and the one of this worker when it has nothing in
+            flight. Returns the number of messages requeued
+        """
+        prefix = self._processing_key('')
+        requeued = 0
+        for processing_key in self._redis.scan_iter(prefix + '*'):
+            worker_id = processing_key[len(prefix):]
+            if worker_id == self.worker_id:
+                with self._ack_lock:
+                    if self._pending:
+                        continue
+            elif self._redis.exists(self._alive_key(worker_id)):
+                continue
 
-                lines.append(log_data)
+            # oldest first, one atomic RPOPLPUSH per message
+            pipe = self._redis.pipeline(transaction=False)
+            for _ in range(self._redis.llen(processing_key)):
+                pipe.rpoplpush(processing_key, self.key)
+            n = len([msg for msg in pipe.execute() if msg is not None])
+            if n:
+                logging.info("requeued %d messages of worker %s", n, worker_id)
+            requeued += n
+        return requeued
 
-                if lines:
-                    index_name = log_data['@fields']['date'][0].replace('-', '.')
-                    self.send_to_es(index_name, lines)
-                    lines = []
+    def consume_batch(self):
+        """Sends one batch of messages to ES, grouped by index, and returns its size"""
+        with metrics.timer('stage_seconds', stage='relay_pop'):
+            msgs = self._pop_batch()
+        metrics.inc('records_total', len(msgs), stage='relay')
+        metrics.inc('bytes_total', sum(len(msg) for msg in msgs), stage='relay')
 
+        started = time.time()
+        by_index = {}
+        bad = []
+        for msg in msgs:
+            try:
+                log_data = json.loads(msg)
+                index_name = _index_name(log_data)
             except Exception as e:
+                logging.error("bad log %r: %s", msg[:200], e)
+                metrics.inc('errors_total', stage='relay_decode', type=e.__class__.__name__)
+                bad.append(msg)
+                continue
+            by_index.setdefault(index_name, []).append(log_data)
+        metrics.observe('stage_seconds', time.time() - started, stage='relay_decode')
+
+        if not self.reliable:
+            if bad:
+                self._redis.rpush(self.failed_key, *bad)
+            for index_name, lines in by_index.iteritems():
+                self.send_to_es(index_name, lines)
+            self.consumed += len(msgs)
+            return len(msgs)
+
+        if msgs:
+            pending = _Pending(msgs, len(by_index) or 1)
+            # acknowledged along with the batch
+            pending.dropped.extend(bad)
+            done = functools.partial(self._done, pending)
+            with self._ack_lock:
+                self._pending.append(pending)
+            for index_name, lines in by_index.iteritems():
+                self.send_to_es(index_name, lines, done)
+            if not by_index:
+                done(0, [], 0)
+        self.consumed += len(msgs)
+        return len(msgs)
+
+    def stop(self):
+        """Makes run return once the current batch is handled"""
+        self._stopped.set()
+
+    def _recover(self):
+        """
+            Stops taking messages until ES is back: waits for the batches
+            in flight, then pings ES every ES_DOWN_WAIT seconds. A
+            reliable relay then requeues its processing list, which holds
+            the messages ES could not take
+        """
+        logging.error("ES is down, pausing the relay")
+        self.es_sink.flush()
+        while not self._stopped.is_set():
+            try:
+                if self.es.ping():
+                    break
+            except Exception:
+                pass
+            time.sleep(ES_DOWN_WAIT)
+        self.es_sink.down.clear()
+
+        if self.reliable:
+            with self._ack_lock:
+                self._pending.clear()
+                self._es_failed.clear()
+            logging.info("ES is back, requeued %d messages", self.reclaim())
+
+    def _collect(self):
+        metrics.set_gauge('queue_depth', self._redis.llen(self.key), queue=self.key, backend=self.redis_url)
+
+    def run(self):
+        if self.reliable:
+            self.start_heartbeat()
+        reclaimed = 0
+        metrics.collect(self._collect)
+
+        while not self._stopped.is_set():
+            try:
+                # at startup, then now and then for the workers which died since
+                if self.reliable and time.time() - reclaimed > HEARTBEAT_TTL:
+                    reclaimed = time.time()
+                    self.reclaim()
+                if self._es_failed.is_set() or self.es_sink.down.is_set():
+                    self._recover()
+                    continue
+                self.consume_batch()
+            except Exception as e:
+                metrics.inc('errors_total', stage='relay', type=e.__class__.__name__)
                 logging.error("pop log fail %s", e, exc_info=True)
+
+        # reliable batches are acknowledged once handled
+        self.es_sink.flush()
         return ""
 
 
@@ -73,6 +355,41 @@ if __name__ == '__main__':
     logger.addHandler(ch)
 
     # other run time options
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis_url", default='redis://127.0.0.1',
+                        help="redis holding the log list, default is redis://127.0.0.1")
+
+    parser.add_argument("--key", default=QUEUE_KEY,
+                        help="redis list of logs, default is %s" % QUEUE_KEY)
+
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="messages taken from redis per cycle, default is %d" % BATCH_SIZE)
+
+    parser.add_argument("--max_wait", type=float, default=MAX_WAIT,
+                        help="seconds a cycle may wait to fill a batch, default is %s" % MAX_WAIT)
+
+    parser.add_argument("--reliable", action='store_true',
+                        help="keep messages in a processing list until ES has handled them")
+
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of relay threads sharing the ES sink, default is 1")
+
+    parser.add_argument("--metrics_port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+
+    parser.add_argument("--metrics_file",
+                        help="write Prometheus metrics to this file every %ds" % metrics.EXPORT_INTERVAL)
+
+    args = parser.parse_args()
+    metrics.start(args.metrics_port, args.metrics_file)
 
-    fetch_app = FetchLog()
-    fetch_app.run()
+    es_sink = ESBulkSink(Elasticsearch(serializer=serializer.ESSerializer()))
+    relays = [FetchLog(args.redis_url, args.key, batch_size=args.batch_size, max_wait=args.max_wait,
+                       es=es_sink.es, es_sink=es_sink, reliable=args.reliable,
+                       worker_id='%s:%d:%d' % (socket.gethostname(), os.getpid(), n))
+              for n in range(args.workers)]
+    for relay in relays[1:]:
+        t = threading.Thread(target=relay.run)
+        t.daemon = True
+        t.start()
+    relays[0].run()
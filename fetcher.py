@@ -4,28 +4,38 @@ import time
 import os
 
 import logging
-import ConfigParser
 
-from dateutil import tz
 from datetime import datetime
 from datetime import timedelta
-import copy
 
-from google.appengine.ext.remote_api import remote_api_stub
 from google.appengine.api.logservice import logservice
-from google.appengine.ext.remote_api.remote_api_stub import ConfigurationError
 
 import getpass
 import simplejson as json
 import base64
 
 import argparse
+import threading
+import itertools
+import collections
+import Queue
+from config import read_config, GAE_TZ, MAX_BUFFER_RECORDS, MAX_BUFFER_BYTES, STATUS_INTERVAL
 from redis_transport import RedisTransports
+from remote_api_session import RemoteApiSession
+from checkpoint import CheckpointStore, checkpoint_key, CHECKPOINTS
+from timefmt import TimeFormatter
+from record import LogRecord
+from dedup import SeenSet, event_id, CAPACITY
+from filters import read_filters
+from sinks import Delivery, SinkError, SinkFanout, SINK_QUEUE
+from archive import ArchiveWriter, EXTENSIONS, FORMATS, ROTATE_BYTES, ROTATE_S
+import metrics
 
 import os.path as osp
 import socket
 socket.setdefaulttimeout(30)
 
+# legacy recovery log, read once when the checkpoint store has no entry
 RECOVERY_LOG = '/tmp/recovery.log'
 
 # end_time is 3 mins before now
@@ -34,31 +44,51 @@ PERIOD_END_NOW = 60 * 3
 # period length
 PERIOD_LENGTH = 60
 
-GAE_TZ = tz.gettz('US/Pacific')
+# seconds between two checks whether the fetch window moved past PERIOD_END_NOW
+CATCH_UP_WAIT = 5
+
+# req logs delivered between two offset checkpoints of an interval
+CHECKPOINT_EVERY = 1000
+
+# attempts again at an interval which failed, the first after RETRY_WAIT
+# seconds and each next one waiting twice as long, before the fetch stops
+# at the checkpoint of the interval
+INTERVAL_RETRIES = 5
+RETRY_WAIT = 5
+
+# intervals handed to the sinks which may wait for their acks while the
+# next ones are fetched, seconds between two checks of the acks, and
+# seconds the commit stage waits for the acks of an interval before it
+# is retried
+MAX_UNACKED = 10
+ACK_POLL_S = 0.05
+ACK_TIMEOUT = 300
+
+# seconds between two polls of the head of the follow mode, and seconds
+# every poll goes back for the req logs logservice shows late
+FOLLOW_POLL_S = 5
+FOLLOW_OVERLAP_S = 5
+
+_times = TimeFormatter(GAE_TZ)
 
 logger = logging.getLogger()
 
-last_offset = None
 last_time_period = None
-close_save_recovery_log = False
 
 ENCODING = "ISO-8859-1"
 
 
-def _get_level(level):
-    # TODO - better?
-    if logservice.LOG_LEVEL_DEBUG == level:
-        return "DEBUG"
-    if logservice.LOG_LEVEL_INFO == level:
-        return "INFO"
-    if logservice.LOG_LEVEL_WARNING == level:
-        return "WARNING"
-    if logservice.LOG_LEVEL_ERROR == level:
-        return "ERROR"
-    if logservice.LOG_LEVEL_CRITICAL == level:
-        return "CRITICAL"
+LEVELS = {
+    logservice.LOG_LEVEL_DEBUG: "DEBUG",
+    logservice.LOG_LEVEL_INFO: "INFO",
+    logservice.LOG_LEVEL_WARNING: "WARNING",
+    logservice.LOG_LEVEL_ERROR: "ERROR",
+    logservice.LOG_LEVEL_CRITICAL: "CRITICAL",
+}
+
 
-    return "UNKNOWN"
+def _get_level(level):
+    return LEVELS.get(level, "UNKNOWN")
 
 
 def get_time_period(start=None, end=None):
@@ -71,27 +101,149 @@ def get_time_period(start=None, end=None):
     return {'start': start, 'end': end, 'start_human': start_human, 'end_human': end_human}
 
 
-def _split_time_period(start, end=None, interval_s=10):
+def _split_time_period(start, end=None, interval_s=10, sizer=None):
     """
         Splits given time_period in segments based on interval
         and returns a list of tuples [(start,end),...]
 
-        Uses seconds since epoch
+        Uses seconds since epoch. If a sizer is given, the length of
+        every segment is asked from it instead of using interval_s.
+        No segment ends later than PERIOD_END_NOW before now, the
+        split waits for that bound to move on instead.
     """
     while not end or start < end:
-        yield start, start + interval_s, datetime.fromtimestamp(start, tz=GAE_TZ)
-        start = start + interval_s
         until_end = int(time.time()) - PERIOD_END_NOW
-        if start >= until_end:
+        while start >= until_end:
             logger.info("start %s is limit to now %s, sleep some time", start, until_end)
-            time.sleep(2 * interval_s)
+            time.sleep(CATCH_UP_WAIT)
+            until_end = int(time.time()) - PERIOD_END_NOW
+        if sizer:
+            interval_s = sizer.interval_s
+        stop = min(start + interval_s, until_end)
+        if end:
+            stop = min(stop, end)
+        yield start, stop, datetime.fromtimestamp(start, tz=GAE_TZ)
+        start = stop
+
+
+class AdaptiveInterval(object):
+    """
+        Sizes fetch intervals from the record count and fetch latency of
+        recent intervals, aiming at target_records req logs per fetch
+    """
 
-def save_recovery_log(timestamp):
-    if close_save_recovery_log:
-        return
-    a = file(RECOVERY_LOG, 'w')
-    a.write(str(timestamp))
-    a.close()
+    def __init__(self, target_records, interval_s=10, min_s=1, max_s=300, max_latency_s=30):
+        self.target_records = target_records
+        self.interval_s = interval_s
+        self.min_s = min_s
+        self.max_s = max_s
+        self.max_latency_s = max_latency_s
+        self._rate = None
+        self._lock = threading.Lock()
+
+    def observe(self, interval_s, records, latency_s):
+        """Records the outcome of a fetched interval and resizes the next ones"""
+        if interval_s <= 0:
+            return
+        with self._lock:
+            rate = records / float(interval_s)
+            if self._rate is None:
+                self._rate = rate
+            else:
+                # smooth out single noisy intervals
+                self._rate = (self._rate + rate) / 2
+
+            if self._rate > 0:
+                size = self.target_records / self._rate
+            else:
+                size = self.interval_s * 2
+
+            if latency_s > self.max_latency_s:
+                size = min(size, interval_s * self.max_latency_s / latency_s)
+
+            self.interval_s = int(max(self.min_s, min(self.max_s, size)))
+
+        logger.debug("%d req logs in %ss (%.1fs), next interval is %ss",
+                     records, interval_s, latency_s, self.interval_s)
+
+
+class WorkerPool(object):
+    """Threads processing the intervals of one or more GAEFetchLog"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._tasks = Queue.Queue()
+        for _ in range(workers):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, results, seq, interval, func):
+        """Runs func(interval) and puts (seq, interval, result, exc_info) on results"""
+        self._tasks.put((results, seq, interval, func))
+
+    def shutdown(self):
+        """Ends the threads once the intervals submitted so far are processed"""
+        for _ in range(self.workers):
+            self._tasks.put(None)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            results, seq, interval, func = task
+            try:
+                results.put((seq, interval, func(interval), None))
+            except:
+                results.put((seq, interval, 0, sys.exc_info()))
+
+
+def fetch_apps(fetchers, runs, workers, **options):
+    """
+        Fetches several apps from one process. runs holds a
+        (time_period, resume kwargs) pair per fetcher. Their intervals
+        share one pool of worker threads, each app having at most
+        2 * workers / apps of them in flight so that a busy app cannot
+        starve the others.
+    """
+    pool = WorkerPool(workers)
+    in_flight = max(1, 2 * workers / len(fetchers))
+
+    threads = []
+    for fetcher, (time_period, resume) in zip(fetchers, runs):
+        kwargs = dict(options, pool=pool, in_flight=in_flight, **resume)
+        t = threading.Thread(target=fetcher.fetch_logs, args=(time_period,), kwargs=kwargs)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    status_logged = time.time()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+            if time.time() - status_logged > STATUS_INTERVAL:
+                for fetcher in fetchers:
+                    logger.info(fetcher.status())
+                status_logged = time.time()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for fetcher in fetchers:
+            logger.info(fetcher.status())
+            if fetcher.checkpoints:
+                fetcher.checkpoints.flush()
+
+
+def read_recovery_log():
+    """
+        Returns (timestamp, end, offset) from a recovery log written by
+        older versions, before the checkpoint store
+    """
+    parts = file(RECOVERY_LOG).read().split()
+    if len(parts) == 3:
+        return int(parts[0]), int(parts[1]), parts[2]
+    return int(parts[0]), None, None
 
 environments = {
     'agent8-backend' : 'production',
@@ -101,69 +253,379 @@ environments = {
 
 class GAEFetchLog(object):
 
-    def __init__(self, app_name, redis_namespace, redis_urls, udp_host, udp_port):
+    def __init__(self, app_name, redis_namespace, redis_urls, udp_host, udp_port,
+                 max_buffer_records=MAX_BUFFER_RECORDS, max_buffer_bytes=MAX_BUFFER_BYTES,
+                 sizer=None, checkpoint_every=CHECKPOINT_EVERY, checkpoints=None,
+                 version_ids=None, redis_transports=None, archive=None, sinks=None,
+                 udp_batch_bytes=0, seen=None, request_filter=None):
         self.app_name = app_name
         self.redis_urls = redis_urls
         self.redis_namespace = redis_namespace
         self.udp_host = udp_host
         self.udp_port = udp_port
-        self.version_ids = ['1']
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.version_ids = version_ids or ['1']
+        # shared by the LogRecords of this app
+        self._type = '%s-gae' % app_name
+        self._environment = environments[app_name]
+        self.session = RemoteApiSession(app_name)
+        self.fetched = 0
+        self.failed = 0
+        self.max_buffer_records = max_buffer_records
+        self.max_buffer_bytes = max_buffer_bytes
+        self.sizer = sizer
+        self.checkpoint_every = checkpoint_every
+        self.checkpoints = checkpoints
+        self.checkpoint_key = checkpoint_key(app_name, self.version_ids)
+        self._checkpoint_lock = threading.Lock()
+        self._committed = None
+        self._resume_offsets = {}
+        # (offset, count) of the last offset checkpoint of an interval, and
+        # the count an interval resumed from that offset starts at
+        self._offset_counts = {}
+        self._resume_counts = {}
+        # written by --save_to_file, created on first use unless shared
+        self.archive = archive
+        # shared along with redis_transports by the fetchers of several apps
+        self.sinks = sinks or SinkFanout()
+        self.udp_batch_bytes = udp_batch_bytes
+        # SeenSet dropping the req logs sent already, may be shared too
+        self.seen = seen
+        # filters.RequestFilter, req logs it drops are never prepared
+        self.request_filter = request_filter
         
-        self.redis_transports = RedisTransports(redis_namespace,  self.redis_urls, hostname='%s.appspot.com' % app_name, format='raw', logger=logger)
-
-    def send_to_udp(self, filename, line):
-        line = copy.deepcopy(line)
-        msg = self.redis_transports.format(filename, format="logcenter", **line)
-        try:
-            self.s.sendto(msg, (self.udp_host, self.udp_port))
-        except:
-            pass
-
+        self.redis_transports = redis_transports or RedisTransports(redis_namespace,  self.redis_urls, hostname='%s.appspot.com' % app_name, format='raw', logger=logger)
+
+    def status(self):
+        """Returns a one line summary of the progress of this fetcher"""
+        stats = self.session.stats()
+        lag = self._committed and int(time.time()) - self._committed or 0
+        return "%s (versions %s): %d req logs, %ds behind, %d fetches in %.1fs" % (
+            self.app_name, ','.join(self.version_ids), self.fetched, lag,
+            stats['fetches'], stats['fetch_s'])
+
+    def _save_checkpoint(self, timestamp, offset=None, end=None):
+        """
+            Records where to resume: either the start of the next interval, or
+            the logservice offset reached inside the interval [timestamp, end)
+        """
+        if self.checkpoints:
+            self.checkpoints.set(self.checkpoint_key, timestamp, end=end, offset=offset)
 
     def _prepare_json(self, filename, req_log):
         """Prepare JSON in logstash json_event format"""
-        data = {'fields': {}}
-        data['type'] = '%s-gae' % self.app_name
-        data['tags'] = ['gae']
-        data['fields']['response'] = req_log.status
-        data['fields']['latency_ms'] = req_log.latency
-        data['fields']['timestamp'] = req_log.end_time
-        data['fields']['environment'] = environments[self.app_name]
-
-
         # Timestamp - this helps if events are not coming in chronological
         # order
-        t = datetime.fromtimestamp(req_log.end_time)
-        t = t.replace(tzinfo=GAE_TZ)
-        data['timestamp'] = t.isoformat()
+        timestamp = _times.isoformat(req_log.end_time)
 
         # processing APP Logs
         msg = req_log.combined
-        #data['line'] = msg
-        #self.send_to_udp(filename, data)
 
-        if len(req_log.app_logs) > 0:
-            app_log_msgs = []
-            for app_log in req_log.app_logs:
-                t = datetime.fromtimestamp(app_log.time)
-                t = t.replace(tzinfo=GAE_TZ)
-                l = _get_level(app_log.level)
-                app_log_msg = "%s %s %s" % (t.isoformat(), l, app_log.message)
-                #data['line'] = app_log_msg
-                
-                #self.send_to_udp(filename, data)
+        app_logs = req_log.app_logs
+        if self.request_filter:
+            app_logs = self.request_filter.app_logs(app_logs)
 
+        if len(app_logs) > 0:
+            app_log_msgs = []
+            for app_log in app_logs:
+                l = LEVELS.get(app_log.level, "UNKNOWN")
+                app_log_msg = "%s %s %s" % (_times.isoformat(app_log.time), l, app_log.message)
                 app_log_msgs.append(app_log_msg)
 
             # The new lines give it more readability in Kibana
             msg = msg + "\n\n" + "\n".join(app_log_msgs)
 
-        data['line'] = msg
-
-        return data
-
-    def fetch_logs(self, time_period, save_to_file=False, send_to_es=False, send_to_udp=False):
+        return LogRecord(self._type, timestamp, msg, req_log.status, req_log.latency,
+                         req_log.end_time, self._environment,
+                         id=event_id(req_log.request_id, req_log.end_time))
+
+    def _iter_req_logs(self, interval, position, follow=False):
+        """
+            Yields the request logs of a single interval as they are fetched,
+            keeping the offset of the last one in position['offset']. The
+            follow head leaves out the incomplete ones, their id changes
+            once they end and the checkpointed fetch sends them then.
+        """
+        start, end, start_human = interval
+        offset = self._resume_offsets.pop(start, None)
+        if offset:
+            logger.info("Resuming interval %s - %s from offset %s", start, end, offset)
+
+        minimum_log_level = logservice.LOG_LEVEL_INFO
+        include_app_logs = True
+        if self.request_filter:
+            minimum_log_level = self.request_filter.minimum_log_level
+            include_app_logs = self.request_filter.include_app_logs()
+
+        for req_log in self.session.fetch(end_time=end,
+                                          start_time=start,
+                                          minimum_log_level=minimum_log_level,
+                                          version_ids=self.version_ids,
+                                          include_app_logs=include_app_logs, include_incomplete=not follow,
+                                          offset=offset):
+
+            logger.debug("Retrieved - %s" % req_log.combined)
+
+            position['offset'] = req_log.offset
+            yield req_log
+
+    def _iter_prepared(self, dest, req_logs, position):
+        """Yields prepared lines, adding the time spent to position['prepare_s']"""
+        for req_log in req_logs:
+            if self.request_filter and not self.request_filter.keep(req_log):
+                continue
+            started = time.time()
+            line = self._prepare_json(dest, req_log)
+            position['prepare_s'] += time.time() - started
+            yield line
+
+    def _iter_chunks(self, lines):
+        """
+            Groups prepared lines into chunks of at most max_buffer_records
+            lines and (roughly) max_buffer_bytes bytes of log text
+        """
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line.line)
+            if len(chunk) >= self.max_buffer_records or size >= self.max_buffer_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+        if chunk:
+            yield chunk
+
+    def _deliver(self, interval, lines, save_to_file=False, send_to_es=False, send_to_udp=False):
+        """
+            Hands one chunk of an interval to the configured sinks, which
+            send it concurrently, and returns its Delivery. The seen set
+            remembers the lines once every sink sent them.
+        """
+        start, end, start_human = interval
+        index_name = start_human.strftime('%Y.%m.%d')
+        dest = self._dest(interval)
+        delivery = Delivery(self.seen and (lambda: self.seen.update(lines)))
+
+        if send_to_es:
+            self.sinks.deliver('es', self._send_to_es, delivery, index_name, dest, lines, delivery=delivery)
+        else:
+            self.sinks.deliver('redis', self.redis_transports.callback, dest, lines, delivery=delivery)
+
+        if send_to_udp:
+            self.sinks.deliver('udp', self.redis_transports.send_to_udp, dest, lines,
+                               self.udp_host, self.udp_port, self.udp_batch_bytes, delivery=delivery)
+
+        if save_to_file:
+            if not self.archive:
+                self.archive = ArchiveWriter(save_to_file)
+            self.sinks.deliver('archive', self.archive.write_lines, dest, lines, delivery=delivery)
+
+        delivery.seal()
+        return delivery
+
+    def _send_to_es(self, delivery, index_name, dest, lines):
+        """send_to_es, holding delivery until the lines are indexed"""
+        release = delivery.hold()
+        try:
+            self.redis_transports.send_to_es(index_name, dest, lines,
+                                             done=lambda indexed, dropped, failed: release(not failed))
+        except:
+            release(False)
+            raise
+
+    def _process_interval(self, interval, follow=False, **sink_options):
+        """
+            Streams a single interval from logservice to the sinks,
+            flushing in bounded chunks, and returns the number of
+            request logs delivered along with the (delivery, count,
+            offset) of the chunks the sinks did not ack yet. Raises
+            SinkError when a sink failed on a chunk. An offset is only
+            checkpointed when every chunk up to it was sent. Intervals
+            of the follow head neither checkpoint nor size the next
+            intervals.
+        """
+        dest = self._dest(interval)
+        count = self._resume_counts.pop(interval[0], 0)
+        checkpointed = count
+        # (delivery, count, offset) of the chunks not known to be sent
+        deliveries = collections.deque()
+        delivered = count
+        offset = None
+        started = time.time()
+        position = {'prepare_s': 0}
+        lines = self._iter_prepared(dest, self._iter_req_logs(interval, position, follow), position)
+        for chunk in self._iter_chunks(lines):
+            metrics.observe('stage_seconds', position['prepare_s'], stage='prepare')
+            position['prepare_s'] = 0
+            if self.seen:
+                fetched = len(chunk)
+                chunk = self.seen.filter(chunk)
+                metrics.inc('duplicates_total', fetched - len(chunk), app=self.app_name)
+                if not chunk:
+                    continue
+            with metrics.timer('stage_seconds', stage='deliver'):
+                delivery = self._deliver(interval, chunk, **sink_options)
+            metrics.inc('records_total', len(chunk), stage='fetch', app=self.app_name)
+            metrics.inc('bytes_total', sum(len(line.line) for line in chunk), stage='fetch', app=self.app_name)
+            count += len(chunk)
+            deliveries.append((delivery, count, position['offset']))
+            logger.debug("Flushed %s req logs of %s", len(chunk), dest)
+
+            while deliveries and deliveries[0][0].done.is_set():
+                delivery, delivered, offset = deliveries.popleft()
+                self._check_delivery(interval, delivery)
+
+            # only the oldest uncommitted interval may move the checkpoint
+            if not follow and delivered - checkpointed >= self.checkpoint_every and interval[0] == self._committed:
+                with self._checkpoint_lock:
+                    self._save_checkpoint(interval[0], offset, interval[1])
+                    self._offset_counts[interval[0]] = (offset, delivered)
+                checkpointed = delivered
+
+        if self.sizer and not follow:
+            self.sizer.observe(interval[1] - interval[0], count, time.time() - started)
+        metrics.observe('stage_seconds', time.time() - started, stage='interval')
+        return count, deliveries
+
+    def _check_delivery(self, interval, delivery):
+        if delivery.failed:
+            raise SinkError("%d sinks failed on a chunk of %s - %s" % (delivery.failed, interval[0], interval[1]))
+
+    def _wait_acked(self, interval, result):
+        """
+            Waits at most ACK_TIMEOUT seconds for the sinks to ack the
+            chunks of a processed interval and returns its count. Raises
+            SinkError when a chunk failed or was not acked in time.
+        """
+        count, deliveries = result
+        deadline = time.time() + ACK_TIMEOUT
+        for delivery, delivered, offset in deliveries:
+            if not delivery.done.wait(max(deadline - time.time(), 0)):
+                raise SinkError("Sinks did not ack %s - %s in %ss" % (interval[0], interval[1], ACK_TIMEOUT))
+            self._check_delivery(interval, delivery)
+        return count
+
+    def _iter_processed(self, intervals, pool, in_flight=2, **sink_options):
+        """
+            Processes intervals with the worker threads of pool, at most
+            in_flight of them at a time, and yields (interval, result,
+            exc_info) in interval order, result being what
+            _process_interval returned.
+
+            An interval is yielded once the sinks acked every chunk of
+            it, or it failed, so that it can be committed while the next
+            ones are processed. Intervals that complete early are held
+            back until every earlier interval has been yielded; when
+            MAX_UNACKED are held, or none is left to process, the oldest
+            one is yielded to be waited for.
+        """
+        def acked(entry):
+            interval, result, exc_info = entry
+            return exc_info or all(delivery.done.is_set() for delivery, delivered, offset in result[1])
+
+        results = Queue.Queue()
+        slots = threading.Semaphore(in_flight)
+        held = threading.Semaphore(in_flight + MAX_UNACKED)
+        stopping = threading.Event()
+
+        def process(interval):
+            if stopping.is_set():
+                return 0, ()
+            return self._process_interval(interval, **sink_options)
+
+        def feed():
+            seq = 0
+            for interval in intervals:
+                held.acquire()
+                slots.acquire()
+                if stopping.is_set():
+                    break
+                pool.submit(results, seq, interval, process)
+                seq += 1
+            results.put((seq, None, None, None))
+
+        t = threading.Thread(target=feed)
+        t.daemon = True
+        t.start()
+
+        pending = {}
+        next_seq = 0
+        last_seq = None
+        try:
+            while last_seq is None or next_seq < last_seq:
+                entry = pending.get(next_seq)
+                if entry and (acked(entry) or len(pending) > MAX_UNACKED or last_seq is not None):
+                    yield pending.pop(next_seq)
+                    next_seq += 1
+                    held.release()
+                    continue
+
+                try:
+                    seq, interval, result, exc_info = results.get(timeout=ACK_POLL_S)
+                except Queue.Empty:
+                    continue
+                if interval is None:
+                    last_seq = seq
+                else:
+                    pending[seq] = (interval, result, exc_info)
+                    slots.release()
+        finally:
+            stopping.set()
+            slots.release()
+            held.release()
+
+    def _retry_interval(self, interval, exc_info, **sink_options):
+        """
+            Processes again an interval which raised exc_info, from the
+            offset it checkpointed, waiting longer before every attempt,
+            and returns its count once the sinks acked it. Raises the
+            last error after INTERVAL_RETRIES attempts.
+        """
+        start, end, start_human = interval
+        wait = RETRY_WAIT
+        for attempt in range(INTERVAL_RETRIES):
+            metrics.inc('errors_total', stage='interval', type=exc_info[0].__name__)
+            logger.error("Interval %s - %s failed, retrying in %ss", start, end, wait, exc_info=exc_info)
+            time.sleep(wait)
+            wait *= 2
+
+            # the req logs up to the offset were delivered and are counted
+            if start in self._offset_counts:
+                self._resume_offsets[start], self._resume_counts[start] = self._offset_counts[start]
+            try:
+                return self._wait_acked(interval, self._process_interval(interval, **sink_options))
+            except KeyboardInterrupt:
+                raise
+            except:
+                exc_info = sys.exc_info()
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _follow(self, stop, poll_s, overlap_s, **sink_options):
+        """
+            Head of the follow mode: every poll_s, delivers the req logs
+            which ended since the last poll, going overlap_s further back.
+            The checkpointed fetch trails PERIOD_END_NOW behind and sends
+            the req logs the head missed; the seen set drops the others.
+        """
+        last = time.time()
+        while not stop.wait(poll_s):
+            end = time.time()
+            start = last - overlap_s
+            try:
+                self._process_interval((start, end, datetime.fromtimestamp(start, tz=GAE_TZ)),
+                                       follow=True, **sink_options)
+                last = end
+                metrics.set_gauge('ingest_lag_seconds', time.time() - end, app=self.app_name, mode='follow')
+            except Exception as e:
+                metrics.inc('errors_total', stage='follow', type=e.__class__.__name__)
+                logger.error("Following %s failed", self.app_name, exc_info=True)
+
+    def _dest(self, interval):
+        return '%s-%s.log' % (self.app_name, interval[2].strftime('%Y-%m-%d'))
+
+    def fetch_logs(self, time_period, save_to_file=False, send_to_es=False, send_to_udp=False, workers=1,
+                   resume_end=None, resume_offset=None, pool=None, in_flight=None,
+                   follow=False, follow_poll_s=FOLLOW_POLL_S, follow_overlap_s=FOLLOW_OVERLAP_S):
         f = lambda: (self.username, self.password)
 
         
@@ -176,69 +638,104 @@ class GAEFetchLog(object):
         start = time_period['start']
         start_human = time_period['start_human']
 
-        intervals = _split_time_period(start, end)
+        intervals = _split_time_period(start, end, sizer=self.sizer)
+        if resume_offset:
+            # the offset is only valid for the interval it was taken from
+            self._resume_offsets[start] = resume_offset
+            intervals = itertools.chain([(start, resume_end, start_human)],
+                                        _split_time_period(resume_end, end, sizer=self.sizer))
+        self._committed = start
+
+        # a pool of this fetch only, ended along with it
+        own_pool = None
+        if not pool:
+            pool = own_pool = WorkerPool(max(workers, 1))
+        if not in_flight:
+            in_flight = 2 * pool.workers
 
         i = 0
-        
-        
-        for interval in intervals:
-            try:
-                start, end, start_human = interval
-                index_name = start_human.strftime('%Y.%m.%d')
-                dest = '%s-%s.log' % (app_name, start_human.strftime('%Y-%m-%d'))
-
+        stats_logged = time.time()
+
+        # an open ended fetch may follow the logs closely too
+        following = threading.Event()
+        if follow and not end:
+            if not self.seen:
+                self.seen = SeenSet()
+            t = threading.Thread(target=self._follow, args=(following, follow_poll_s, follow_overlap_s),
+                                 kwargs={'save_to_file': save_to_file, 'send_to_es': send_to_es,
+                                         'send_to_udp': send_to_udp})
+            t.daemon = True
+            t.start()
+            logger.info("Following %s every %ss", self.app_name, follow_poll_s)
 
-                logger.info("Interval : %s - %s %s" % (start, end, start_human))
-
-                save_recovery_log(start)
-                lines = []
-                offset = None
-                remote_api_stub.ConfigureRemoteApiForOAuth(self.app_name + '.appspot.com', '/remote_api')
-            
-                for req_log in logservice.fetch(end_time=end,
-                                                start_time=start,
-                                                minimum_log_level=logservice.LOG_LEVEL_INFO,
-                                                version_ids=self.version_ids,
-                                                include_app_logs=True, include_incomplete=True,
-                                                offset=offset):
-
-                    logger.debug("Retrieved - %s" % req_log.combined)
-
-                    lines.append(self._prepare_json(dest, req_log))
-
-                    i = i + 1
-                    if i % 100 == 0:
-                        logger.info("Fetched %d req logs so far" % i)
+        try:
+            processed = self._iter_processed(intervals, pool, in_flight, save_to_file=save_to_file,
+                                             send_to_es=send_to_es, send_to_udp=send_to_udp)
+            for interval, result, exc_info in processed:
+                try:
+                    start, end, start_human = interval
+
+                    logger.info("Interval : %s - %s %s" % (start, end, start_human))
+
+                    if not exc_info:
+                        try:
+                            count = self._wait_acked(interval, result)
+                        except SinkError:
+                            exc_info = sys.exc_info()
+                    if exc_info:
+                        count = self._retry_interval(interval, exc_info, save_to_file=save_to_file,
+                                                     send_to_es=send_to_es, send_to_udp=send_to_udp)
+
+                    i = i + count
+                    self.fetched += count
+                    logger.info("%s: fetched %d req logs so far" % (self.app_name, i))
 
-                    # end fetch
-                if lines:
                     if send_to_es:
-                        self.redis_transports.send_to_es(index_name, dest, lines)
+                        logger.info("Save to es %s", count)
                     else:
-                        self.redis_transports.callback(dest, lines)
-
-                    #if send_to_udp:
-                    #    self.redis_transports.send_to_udp(dest, lines, self.udp_host, self.udp_port)
-
-                if save_to_file:
-                    f = file(os.path.join(save_to_file, dest), 'a')
-                    f.write('\n'.join([x['line'] for x in lines]))
-                    f.close()
-
-                if send_to_es:
-                    logger.info("Save to es %s", len(lines))
-                else:
-                    logger.info("Save to redis %s", len(lines))
-                # end interval
-            except KeyboardInterrupt:
-                return
-            except:
-                logger.error("Something went wrong", exc_info=True)
-                continue
-
-        logger.info("Retrieved %d logs. Done." % i)
-
-        return ""
+                        logger.info("Save to redis %s", count)
+                    # end interval
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    # neither this interval nor any later one is committed,
+                    # a restart resumes from the checkpoint
+                    self.failed += 1
+                    metrics.inc('errors_total', stage='interval', type=sys.exc_info()[0].__name__)
+                    logger.error("Interval %s - %s failed %d times, stopping", start, end,
+                                 INTERVAL_RETRIES + 1, exc_info=True)
+                    break
+
+                # intervals are committed in order, so every earlier
+                # interval has been handled by now
+                with self._checkpoint_lock:
+                    self._save_checkpoint(end)
+                    self._committed = end
+                    self._offset_counts.pop(start, None)
+                metrics.set_gauge('ingest_lag_seconds', time.time() - end, app=self.app_name)
+
+                if time.time() - stats_logged > 3600:
+                    self.session.log_stats()
+                    self.redis_transports.log_stats()
+                    stats_logged = time.time()
+        except KeyboardInterrupt:
+            self.session.log_stats()
+            return
+        finally:
+            following.set()
+            if own_pool:
+                own_pool.shutdown()
+            self.sinks.flush()
+            self.redis_transports.flush()
+            if self.archive:
+                self.archive.flush()
+            if self.checkpoints:
+                self.checkpoints.flush()
+
+        self.session.log_stats()
+        logger.info("%s: retrieved %d logs. Done." % (self.app_name, i))
+
+        return i
 
 
 if __name__ == '__main__':
@@ -260,49 +757,158 @@ if __name__ == '__main__':
     parser.add_argument("--save_to_file",
                         help="save to file also")
 
+    parser.add_argument("--archive_compression", choices=sorted(EXTENSIONS), default='gzip',
+                        help="compression of the --save_to_file archive, default is gzip")
+
+    parser.add_argument("--archive_format", choices=FORMATS, default='events',
+                        help="archive json_events which replay.py can send again, or only their text, default is events")
+
+    parser.add_argument("--archive_rotate_bytes", type=int, default=ROTATE_BYTES,
+                        help="start a new archive file past this size, default is %d" % ROTATE_BYTES)
+
+    parser.add_argument("--archive_rotate_s", type=int, default=ROTATE_S,
+                        help="start a new archive file after this many seconds, default is a file per app and day")
+
     parser.add_argument("--send_to_es",
                         help="dir send to es", action='store_true')
 
     parser.add_argument("--send_to_udp",
                         help="dir send to es", action='store_true')
 
+    parser.add_argument("--udp_batch_bytes", type=int, default=0,
+                        help="pack newline separated events in UDP datagrams of up to this size, default is one event per datagram")
+
+    parser.add_argument("--sink_queue", type=int, default=SINK_QUEUE,
+                        help="chunks waiting for a sink before the fetch waits for it, default is %d" % SINK_QUEUE)
+
+    parser.add_argument("--dedup", action='store_true',
+                        help="drop req logs sent already by this process, e.g. when an interval is fetched again")
+
+    parser.add_argument("--dedup_capacity", type=int, default=CAPACITY,
+                        help="req logs per hour of log time remembered before dedup grows, default is %d" % CAPACITY)
+
+    parser.add_argument("--follow", action='store_true',
+                        help="also fetch the last seconds every --follow_poll_s, the checkpointed fetch back-fills what they missed (implies --dedup)")
+
+    parser.add_argument("--follow_poll_s", type=float, default=FOLLOW_POLL_S,
+                        help="seconds between two polls of --follow, default is %d" % FOLLOW_POLL_S)
+
+    parser.add_argument("--follow_overlap_s", type=float, default=FOLLOW_OVERLAP_S,
+                        help="seconds every poll of --follow fetches again, default is %d" % FOLLOW_OVERLAP_S)
+
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of intervals fetched concurrently, default is 1")
+
+    parser.add_argument("--max_buffer_records", type=int, default=MAX_BUFFER_RECORDS,
+                        help="max req logs held in memory before flushing, default is %d" % MAX_BUFFER_RECORDS)
+
+    parser.add_argument("--max_buffer_bytes", type=int, default=MAX_BUFFER_BYTES,
+                        help="max bytes of log text held in memory before flushing, default is %d" % MAX_BUFFER_BYTES)
+
+    parser.add_argument("--target_records", type=int, default=0,
+                        help="size intervals adaptively to fetch about this many req logs each, default is fixed 10s intervals")
+
+    parser.add_argument("--min_interval", type=int, default=1,
+                        help="shortest adaptive interval in seconds, default is 1")
+
+    parser.add_argument("--max_interval", type=int, default=300,
+                        help="longest adaptive interval in seconds, default is 300")
+
+    parser.add_argument("--checkpoint_every", type=int, default=CHECKPOINT_EVERY,
+                        help="save the offset inside an interval every this many req logs, default is %d" % CHECKPOINT_EVERY)
+
+    parser.add_argument("--checkpoints", default=CHECKPOINTS,
+                        help="checkpoint store shared by the fetchers of this host, default is %s" % CHECKPOINTS)
+
     parser.add_argument("--gae_config",
                         help="Config file for GAE user, pass, app. If not specified, it looks for fetcher.conf")
 
+    parser.add_argument("--metrics_port", type=int,
+                        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics")
+
+    parser.add_argument("--metrics_file",
+                        help="write Prometheus metrics to this file every %ds" % metrics.EXPORT_INTERVAL)
+
     args = parser.parse_args()
 
     #logger.setLevel(logging.DEBUG)
+    metrics.start(args.metrics_port, args.metrics_file)
 
     # getting app name & credentials from a file
     conf = args.gae_config or 'fetcher.conf'
 
     RECOVERY_LOG = '%s_%s' % (RECOVERY_LOG, osp.basename(conf))
 
-    config = ConfigParser.SafeConfigParser()
-    config.read(conf)
-
-    app_name = config.get('GAE', 'app_name')
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '%s.json' % app_name
-
-    redis_urls = config.get('REDIS', 'redis_urls')
-    redis_namespace = config.get('REDIS', 'namespace')
-    udp_host = config.get('UDP', 'host')
-    udp_port = int(config.get('UDP', 'port'))
-
-    redis_urls = redis_urls.split(',')
+    app_names, version_ids, redis_namespace, redis_urls, redis_options, es_options, udp_host, udp_port = read_config(conf)
     start_timestamp = args.start_timestamp and int(args.start_timestamp) or None
     end_timestamp = args.end_timestamp and int(args.end_timestamp) or None
 
-    if not start_timestamp:
-        if os.path.exists(RECOVERY_LOG):
-            try:
-                start_timestamp = int(file(RECOVERY_LOG).read())
-            except:
-                pass
-
-    if start_timestamp and end_timestamp:
-        global close_save_recovery_log
-        close_save_recovery_log = True
-
-    gae_fetch_app = GAEFetchLog(app_name, redis_namespace, redis_urls, udp_host, udp_port)
-    gae_fetch_app.fetch_logs(get_time_period(start_timestamp, end_timestamp), save_to_file=args.save_to_file, send_to_es=args.send_to_es, send_to_udp=args.send_to_udp)
+    # a fixed range is a one-off run, it does not move the checkpoint
+    checkpoints = None
+    if not (start_timestamp and end_timestamp):
+        checkpoints = CheckpointStore(args.checkpoints)
+
+    redis_transports = RedisTransports(redis_namespace, redis_urls, hostname='%s.appspot.com' % app_names[0], format='raw', logger=logger,
+                                       es_options=es_options, **redis_options)
+    archive = None
+    if args.save_to_file:
+        archive = ArchiveWriter(args.save_to_file, args.archive_compression,
+                                args.archive_rotate_bytes, args.archive_rotate_s, args.archive_format)
+
+    sinks = SinkFanout(args.sink_queue)
+    seen = None
+    if args.dedup or args.follow:
+        seen = SeenSet(args.dedup_capacity)
+
+    # checkpoints only cover the chunks the sinks acked, the archive
+    # still has to end its members for them to be indexed
+    if checkpoints and archive:
+        checkpoints.before_flush = archive.flush
+
+    fetchers = []
+    runs = []
+    for app_name in app_names:
+        sizer = None
+        if args.target_records:
+            sizer = AdaptiveInterval(args.target_records, min_s=args.min_interval, max_s=args.max_interval)
+
+        gae_fetch_app = GAEFetchLog(app_name, redis_namespace, redis_urls, udp_host, udp_port,
+                                    max_buffer_records=args.max_buffer_records,
+                                    max_buffer_bytes=args.max_buffer_bytes,
+                                    sizer=sizer,
+                                    checkpoint_every=args.checkpoint_every,
+                                    checkpoints=checkpoints,
+                                    version_ids=version_ids.get(app_name),
+                                    redis_transports=redis_transports,
+                                    archive=archive,
+                                    sinks=sinks,
+                                    udp_batch_bytes=args.udp_batch_bytes,
+                                    seen=seen,
+                                    request_filter=read_filters(conf, app_name))
+
+        app_start = start_timestamp
+        resume_end = resume_offset = None
+        if not app_start:
+            checkpoint = checkpoints.get(gae_fetch_app.checkpoint_key)
+            if checkpoint:
+                app_start = checkpoint['timestamp']
+                resume_end = checkpoint['end']
+                resume_offset = checkpoint['offset']
+            elif len(app_names) == 1 and os.path.exists(RECOVERY_LOG):
+                try:
+                    app_start, resume_end, resume_offset = read_recovery_log()
+                except:
+                    pass
+
+        fetchers.append(gae_fetch_app)
+        runs.append((get_time_period(app_start, end_timestamp),
+                     {'resume_end': resume_end, 'resume_offset': resume_offset}))
+
+    options = {'save_to_file': args.save_to_file, 'send_to_es': args.send_to_es, 'send_to_udp': args.send_to_udp,
+               'follow': args.follow, 'follow_poll_s': args.follow_poll_s, 'follow_overlap_s': args.follow_overlap_s}
+    if len(fetchers) == 1:
+        time_period, resume = runs[0]
+        options.update(resume)
+        fetchers[0].fetch_logs(time_period, workers=args.workers, **options)
+    else:
+        fetch_apps(fetchers, runs, args.workers, **options)
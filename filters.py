@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+    Filtering and sampling of req logs, before they are prepared.
+
+    The [FILTERS] section of fetcher.conf sets the rules, an option
+    suffixed with .<app> overriding it for that app:
+
+        minimum_log_level   only req logs with an app log of this level or
+                            above, logservice filters them (default info)
+        include_path        regexps on the path (resource) of a req log:
+        exclude_path        only matching ones are kept, matching ones dropped
+        include_status      regexps on the status, e.g. ^5 or ^(301|304)$
+        exclude_status
+        sample_rate         share of req logs kept, chosen by request id so
+                            every fetch keeps the same ones (default 1)
+        sample_path         regexp, sample only the req logs of these paths
+        app_log_level       app log lines below this level are dropped,
+                            none fetches no app logs at all
+
+    Every rule counts what it dropped in filtered_total{app,rule}.
+"""
+import ConfigParser
+import hashlib
+import re
+import struct
+import threading
+
+import metrics
+
+# the logservice.LOG_LEVEL_* values, none is above all of them
+LEVELS = {'debug': 0, 'info': 1, 'warning': 2, 'error': 3, 'critical': 4, 'none': 5}
+
+OPTIONS = ('minimum_log_level', 'include_path', 'exclude_path', 'include_status', 'exclude_status',
+           'sample_rate', 'sample_path', 'app_log_level')
+
+
+def _sample(request_id, rate):
+    """Whether the req log of request_id is among the rate of them kept"""
+    if isinstance(request_id, unicode):
+        request_id = request_id.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(request_id).digest()[:8])[0] < rate * 2 ** 64
+
+
+def _level(option, value):
+    """The LEVELS value of a level name, in any case"""
+    try:
+        return LEVELS[value.lower()]
+    except KeyError:
+        raise ValueError("%s %r is not one of %s" % (option, value,
+                                                      ', '.join(sorted(LEVELS, key=LEVELS.get))))
+
+
+class RequestFilter(object):
+    """The rules of one app, see the module docstring"""
+
+    def __init__(self, app_name, minimum_log_level='info', include_path=None, exclude_path=None,
+                 include_status=None, exclude_status=None, sample_rate=1.0, sample_path=None,
+                 app_log_level='debug'):
+        self.app_name = app_name
+        self.minimum_log_level = _level('minimum_log_level', minimum_log_level)
+        self.app_log_level = _level('app_log_level', app_log_level)
+        self.sample_rate = float(sample_rate)
+        # (rule, compiled regexp, kept when it matches)
+        self._rules = []
+        for rule, pattern, keep in (('include_path', include_path, True), ('exclude_path', exclude_path, False),
+                                    ('include_status', include_status, True),
+                                    ('exclude_status', exclude_status, False)):
+            if pattern:
+                self._rules.append((rule, re.compile(pattern), keep))
+        self._sample_path = sample_path and re.compile(sample_path)
+        self._dropped = dict.fromkeys([rule for rule, pattern, keep in self._rules] +
+                                      ['sample_rate', 'app_log_level'], 0)
+        self._lock = threading.Lock()
+
+    def include_app_logs(self):
+        return self.app_log_level < LEVELS['none']
+
+    def keep(self, req_log):
+        """Whether req_log passes the rules, counting the rule which dropped it"""
+        for rule, pattern, keep in self._rules:
+            if rule.endswith('_path'):
+                value = req_log.resource
+            else:
+                value = str(req_log.status)
+            if bool(pattern.search(value)) != keep:
+                return self._drop(rule)
+        if self.sample_rate < 1 and (not self._sample_path or self._sample_path.search(req_log.resource)):
+            if not _sample(req_log.request_id, self.sample_rate):
+                return self._drop('sample_rate')
+        return True
+
+    def app_logs(self, app_logs):
+        """The app logs of a req log at app_log_level or above"""
+        if not self.app_log_level:
+            return app_logs
+        kept = [app_log for app_log in app_logs if app_log.level >= self.app_log_level]
+        if len(kept) < len(app_logs):
+            self._drop('app_log_level', len(app_logs) - len(kept))
+        return kept
+
+    def _drop(self, rule, count=1):
+        with self._lock:
+            self._dropped[rule] += count
+        metrics.inc('filtered_total', count, app=self.app_name, rule=rule)
+        return False
+
+    def dropped(self):
+        with self._lock:
+            return dict(self._dropped)
+
+
+def read_filters(conf, app_name):
+    """Returns the RequestFilter of app_name from the [FILTERS] section of conf, None without one"""
+    config = ConfigParser.SafeConfigParser()
+    config.read(conf)
+    if not config.has_section('FILTERS'):
+        return None
+
+    options = {}
+    for option in OPTIONS:
+        for name in ('%s.%s' % (option, app_name), option):
+            if config.has_option('FILTERS', name):
+                options[option] = config.get('FILTERS', name).strip()
+                break
+    return RequestFilter(app_name, **options)
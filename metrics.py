@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    Prometheus-style metrics of the fetcher and the relay.
+
+    Every process keeps its counters, gauges and histograms in REGISTRY.
+    They are rendered in the Prometheus text format, served on a local
+    HTTP port (serve) or written to a file now and then (export), e.g.
+    for the textfile collector of node_exporter.
+
+    The stages of the pipeline share a few metrics, labelled by stage:
+
+        stage_seconds{stage}         histogram, per batch or interval
+        records_total{stage}         counter, rate() gives records/s
+        bytes_total{stage}           counter, rate() gives bytes/s
+        errors_total{stage,type}     counter, by exception class
+        duplicates_total{app}        counter, req logs dropped by dedup
+        filtered_total{app,rule}     counter, req logs (app log lines for
+                                     app_log_level) dropped by a filter
+        queue_depth{queue}           gauge, sampled when rendered
+        ingest_lag_seconds{app}      gauge, now minus the end of the
+                                     last committed interval
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# upper bounds in seconds of the stage_seconds buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# seconds between two writes of the metrics file
+EXPORT_INTERVAL = 15
+
+
+def _labels(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                             for k, v in labels)
+
+
+class Registry(object):
+    """Metrics of one process, const_labels are added to all of them"""
+
+    def __init__(self):
+        self.const_labels = {}
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._buckets = {}
+        self._values = {}
+        self._collectors = []
+
+    def _declare(self, name, type, help):
+        self._types[name] = type
+        self._help[name] = help
+        self._values.setdefault(name, {})
+
+    def counter(self, name, help):
+        self._declare(name, 'counter', help)
+
+    def gauge(self, name, help):
+        self._declare(name, 'gauge', help)
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        self._declare(name, 'histogram', help)
+        self._buckets[name] = buckets
+
+    def collect(self, func):
+        """Calls func() before every render, to sample gauges"""
+        self._collectors.append(func)
+
+    def inc(self, name, value=1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[name][_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = _labels(labels)
+        buckets = self._buckets[name]
+        with self._lock:
+            values = self._values[name]
+            counts = values.get(key)
+            if counts is None:
+                # a count per bucket, +Inf, then the sum
+                counts = values[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observes the duration of the block, counting its errors by type"""
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.inc('errors_total', stage=labels.get('stage', name), type=e.__class__.__name__)
+            raise
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def get(self, name):
+        """Returns the values of name by their sorted (label, value) pairs"""
+        with self._lock:
+            return dict((key, list(value) if isinstance(value, list) else value)
+                        for key, value in self._values[name].iteritems())
+
+    def render(self):
+        for func in self._collectors:
+            try:
+                func()
+            except Exception:
+                logger.warning("Metrics collector %s failed", func, exc_info=True)
+
+        const = self.const_labels.items()
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, self._types[name]))
+                for key, value in sorted(self._values[name].iteritems()):
+                    labels = tuple(const) + key
+                    if self._types[name] != 'histogram':
+                        lines.append('%s%s %s' % (name, _format_labels(labels), repr(float(value))))
+                        continue
+                    total = 0
+                    for bound, count in zip(self._buckets[name] + ('+Inf',), value[:-1]):
+                        total += count
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', bound),)), total))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(value[-1])))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves the metrics on http://host:port/metrics from a daemon thread"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+        return server
+
+    def write(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def export(self, path, interval=EXPORT_INTERVAL):
+        """Rewrites path every interval seconds from a daemon thread"""
+        def export_forever():
+            while True:
+                try:
+                    self.write(path)
+                except Exception:
+                    logger.warning("Writing metrics to %s failed", path, exc_info=True)
+                time.sleep(interval)
+        t = threading.Thread(target=export_forever)
+        t.daemon = True
+        t.start()
+
+
+REGISTRY = Registry()
+REGISTRY.histogram('stage_seconds', 'Duration of a batch or interval in a stage of the pipeline')
+REGISTRY.counter('records_total', 'Records handled by a stage')
+REGISTRY.counter('bytes_total', 'Bytes handled by a stage')
+REGISTRY.counter('errors_total', 'Errors of a stage by type')
+REGISTRY.counter('duplicates_total', 'Req logs dropped as sent already')
+REGISTRY.counter('filtered_total', 'Req logs or app log lines dropped by a filter rule')
+REGISTRY.gauge('queue_depth', 'Items waiting in a queue')
+REGISTRY.gauge('ingest_lag_seconds', 'Seconds between now and the end of the last committed interval')
+
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+timer = REGISTRY.time
+collect = REGISTRY.collect
+
+
+def start(port=None, path=None):
+    """Serves and/or exports REGISTRY as asked on the command line"""
+    if port:
+        REGISTRY.serve(port)
+    if path:
+        REGISTRY.export(path)
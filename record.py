@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Prepared request logs.
+
+    A LogRecord holds what GAEFetchLog._prepare_json takes from a request
+    log in slots, once, instead of a dict of fields inside a dict. Every
+    output format is encoded straight from the slots, without the event
+    dicts formatting used to build:
+
+        raw()           the logstash json_event, pushed to redis and archived
+        logcenter()     the json_event with the logcenter fields, sent over UDP
+        source()        the _source of an ES bulk action, the raw json_event
+
+    The id of a record (see dedup.event_id) is sent as @fields.event_id.
+"""
+from serializer import fast_dumps, _text
+from timefmt import TimeFormatter
+
+# logcenter dates and hours are local to the host, like they always were
+_times = TimeFormatter()
+
+# tags of every GAE req log, shared by the records
+TAGS = ('gae',)
+
+# json of (type, tags), shared by the records of a type
+_heads = {}
+
+
+def _head(type, tags):
+    head = _heads.get((type, tags))
+    if head is None:
+        head = _heads[(type, tags)] = '{"@type": %s, "@tags": %s, ' % (fast_dumps(type), fast_dumps(tags))
+    return head
+
+
+class LogRecord(object):
+    """A request log ready to send, see the module docstring for its formats"""
+
+    __slots__ = ('type', 'tags', 'timestamp', 'line', 'response', 'latency_ms', 'end_time', 'environment', 'id')
+
+    def __init__(self, type, timestamp, line, response, latency_ms, end_time, environment, tags=TAGS, id=None):
+        self.type = type
+        self.tags = tags
+        self.timestamp = timestamp
+        self.line = line
+        self.response = response
+        self.latency_ms = latency_ms
+        self.end_time = end_time
+        self.environment = environment
+        self.id = id
+
+    @classmethod
+    def from_event(cls, data):
+        """The record of a decoded json_event"""
+        fields = data['@fields']
+        return cls(data['@type'], data['@timestamp'], data['@message'], fields['response'],
+                   fields['latency_ms'], fields['timestamp'], fields['environment'],
+                   tuple(data['@tags'] or ()), fields.get('event_id'))
+
+    def _fields(self):
+        fields = '"response": %s, "latency_ms": %s, "timestamp": %s, "environment": %s' % (
+            fast_dumps(self.response), fast_dumps(self.latency_ms),
+            fast_dumps(self.end_time), fast_dumps(self.environment))
+        if self.id:
+            fields += ', "event_id": %s' % fast_dumps(self.id)
+        return fields
+
+    def raw(self):
+        return '%s"@timestamp": %s, "@fields": {%s}, "@message": %s}' % (
+            _head(self.type, self.tags), fast_dumps(self.timestamp), self._fields(),
+            fast_dumps(_text(self.line)))
+
+    # the ES serializers pass encoded sources through
+    source = raw
+
+    def logcenter(self):
+        date, hour = _times.date_hour(self.end_time)
+        return ('%s"@timestamp": %s, "@fields": {%s, "log_line": [0], "log_source": ["gae"], '
+                '"level": ["INFO"], "date": [%s], "hour": [%s], "component": "gae", "type": %s, '
+                '"instance_id": "gae", "instance_name": "gae"}, "@message": %s}') % (
+            _head(self.type, self.tags), fast_dumps(self.timestamp), self._fields(),
+            fast_dumps(date), fast_dumps(hour), fast_dumps(self.type), fast_dumps(_text(self.line)))
+
+    def __repr__(self):
+        return 'LogRecord(%r, %r)' % (self.type, self.timestamp)
@@ -10,10 +10,46 @@ import random
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers
 import socket
-ENCODING = "ISO-8859-1"
+import metrics
+import serializer
+from serializer import ENCODING
+from es_sink import ESBulkSink
+from timefmt import TimeFormatter
+
+_times = TimeFormatter()
 
 class TransportException(Exception):
-    pass
+
+    def __init__(self, message, unsent=None):
+        super(TransportException, self).__init__(message)
+        # the messages a push did not send
+        self.unsent = unsent
+
+
+def _raw(lines):
+    """The json_events pushed for prepared lines"""
+    with metrics.timer('stage_seconds', stage='format'):
+        return [line.raw() for line in lines]
+
+
+def _pack(msgs, max_bytes, max_count=0, sep=0):
+    """
+        Groups messages in batches of at most max_count (0 is no limit)
+        messages and max_bytes bytes, counting sep bytes between two
+    """
+    batch = []
+    size = 0
+    for msg in msgs:
+        if batch and (max_count and len(batch) >= max_count or size + sep + len(msg) > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        if batch:
+            size += sep
+        batch.append(msg)
+        size += len(msg)
+    if batch:
+        yield batch
 
 class BaseTransport(object):
 
@@ -30,7 +66,7 @@ class BaseTransport(object):
         self._logger = logger
 
         def raw_formatter(data):
-            return json.dumps(data, encoding=ENCODING)#data['@message']
+            return serializer.dumps(data)#data['@message']
 
         def rawjson_formatter(data):
             json_data = json.loads(data['@message'])
@@ -50,13 +86,15 @@ class BaseTransport(object):
 
         def logcenter_formatter(data):
             timestamp = data['@fields']['timestamp']
-            log_time = datetime.datetime.fromtimestamp(timestamp)
+            date, hour = _times.date_hour(timestamp)
+            # a copy, the caller's fields must not change
+            data['@fields'] = dict(data['@fields'])
             data['@fields'].update({
                 'log_line' : [0],
                 'log_source': ['gae'],
                 'level': ['INFO'],
-                'date': [log_time.strftime('%Y-%m-%d')],
-                'hour': ['%02d' % log_time.hour],
+                'date': [date],
+                'hour': [hour],
                 'component': 'gae',
                 'type': data['@type'],
                 'instance_id': 'gae',
@@ -128,18 +166,40 @@ class BaseTransport(object):
         return self._is_valid
 
 
+# limits of a single multi-value RPUSH
+RPUSH_MAX_COUNT = 500
+RPUSH_MAX_BYTES = 1024 * 1024
+
+# RPUSH commands sent per pipeline round trip
+MAX_IN_FLIGHT = 8
+
+# seconds between two LLEN while the namespace list is above high water
+BACKPRESSURE_WAIT = 1
+
+
 class RedisTransport(BaseTransport):
 
-    def __init__(self, redis_namespace, redis_url, hostname, format=None, logger=None):
+    def __init__(self, redis_namespace, redis_url, hostname, format=None, logger=None,
+                 rpush_max_count=RPUSH_MAX_COUNT, rpush_max_bytes=RPUSH_MAX_BYTES,
+                 max_in_flight=MAX_IN_FLIGHT, high_water=0):
         super(RedisTransport, self).__init__(hostname, format, logger=logger)
+        self.rpush_max_count = rpush_max_count
+        self.rpush_max_bytes = rpush_max_bytes
+        self.max_in_flight = max_in_flight
+        self.high_water = high_water
+        self._last_depth = 0
 
         _url = urlparse.urlparse(redis_url, scheme='redis')
+        self.redis_url = redis_url
         self._redis = redis.StrictRedis(host=_url.hostname, port=_url.port, socket_timeout=10)
         self._redis_namespace = redis_namespace
         self._is_valid = False
 
         self._connect()
-        self.es = Elasticsearch()
+        self.es = Elasticsearch(serializer=serializer.ESSerializer())
+        # set by RedisTransports, send_to_es is synchronous without it
+        self.es_sink = None
+        self._udp = None
 
     def _connect(self):
         wait = -1
@@ -166,62 +226,292 @@ class RedisTransport(BaseTransport):
     def reconnect(self):
         self._connect()
 
+    def probe(self):
+        """Checks the connection once, without the retries of _connect"""
+        try:
+            self._redis.ping()
+        except Exception:
+            return False
+
+        self._is_valid = True
+        self._pipeline = self._redis.pipeline(transaction=False)
+        return True
+
+    def depth(self):
+        """Returns the length of the namespace list"""
+        return self._redis.llen(self._redis_namespace)
+
     def invalidate(self):
         """Invalidates the current transport"""
         super(RedisTransport, self).invalidate()
         self._redis.connection_pool.disconnect()
         return False
 
+    def _rpush_batches(self, msgs):
+        """Groups messages under the count and byte limits of one RPUSH"""
+        return _pack(msgs, self.rpush_max_bytes, self.rpush_max_count)
+
+    def _wait_for_room(self):
+        """Blocks while the namespace list is longer than high_water"""
+        while self.high_water and self._last_depth > self.high_water:
+            self._logger.info("%s has %d messages, above %d, waiting",
+                              self._redis_namespace, self._last_depth, self.high_water)
+            time.sleep(BACKPRESSURE_WAIT)
+            self._last_depth = self.depth()
+
+    def _execute(self):
+        # RPUSH replies with the length of the list, no LLEN needed
+        replies = self._pipeline.execute()
+        if replies:
+            self._last_depth = replies[-1]
+
     def callback(self, filename, lines, **kwargs):
-        for line in lines:
-            msg = self.format(filename, **line)
-            self._pipeline.rpush(
-                self._redis_namespace,
-                msg
-            )
+        self.push(_raw(lines))
 
+    def push(self, msgs):
+        """
+            RPUSHes encoded messages, max_in_flight batches per round
+            trip. A connection error raises a TransportException whose
+            unsent are the messages after the last round which went
+            through (those of the failed round may have been pushed).
+        """
+        started = time.time()
+        sent = 0
+        queued = []
         try:
-            self._pipeline.execute()
-        except redis.exceptions.ConnectionError, e:
+            self._wait_for_room()
+            for batch in self._rpush_batches(msgs):
+                self._pipeline.rpush(self._redis_namespace, *batch)
+                queued.append(len(batch))
+                if len(queued) >= self.max_in_flight:
+                    self._execute()
+                    sent += sum(queued)
+                    queued = []
+            if queued:
+                self._execute()
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError), e:
             traceback.print_exc()
-            raise TransportException(str(e))
+            self._pipeline.reset()
+            metrics.inc('errors_total', stage='redis', type=e.__class__.__name__)
+            raise TransportException(str(e), msgs[sent:])
+        finally:
+            metrics.observe('stage_seconds', time.time() - started, stage='redis')
+
+        metrics.inc('records_total', len(msgs), stage='redis')
+        metrics.inc('bytes_total', sum(len(msg) for msg in msgs), stage='redis')
 
-    def send_to_es(self, index_name, filename, lines, **kwargs):
+    def send_to_es(self, index_name, filename, lines, done=None, **kwargs):
+        """Indexes lines, done(indexed, dropped, failed) is called once ES handled them"""
         actions = []
+        started = time.time()
         for line in lines:
-            msg = json.loads(self.format(filename, **line))
-
             action = {
                 "_index": "logstash-%s" % index_name,
-                "_type": msg['@type'],
+                "_type": line.type,
                 #"_version": "1",
-                "_source": msg
+                "_source": line.source()
             }
+            # re-fetched req logs overwrite their document
+            if line.id:
+                action['_id'] = line.id
 
             actions.append(action)
+        metrics.observe('stage_seconds', time.time() - started, stage='format')
         logging.info("save to es[index_name: %s, type: %s, actions: %s]", action['_index'], action['_type'], len(actions))
 
-        helpers.bulk(self.es, actions, chunk_size=100, params={'request_timeout': 90})
+        if self.es_sink:
+            self.es_sink.put_many(actions, done)
+        else:
+            helpers.bulk(self.es, actions, chunk_size=100, params={'request_timeout': 90})
+            if done:
+                done(len(actions), [], 0)
 
-    def send_to_udp(self, filename, lines, host, port, **kwargs):
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        for line in lines:
-            msg = self.format(filename, format="logcenter", **line)
+    def send_to_udp(self, filename, lines, host, port, max_bytes=0, **kwargs):
+        """
+            Sends the logcenter format of lines, a datagram each, or
+            packed newline separated in datagrams of up to max_bytes
+        """
+        if not self._udp:
+            self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        msgs = [line.logcenter() for line in lines]
+
+        datagrams = msgs
+        if max_bytes:
+            datagrams = ['\n'.join(batch) for batch in _pack(msgs, max_bytes, sep=1)]
+        for datagram in datagrams:
             try:
-                s.sendto(msg, (host, port))
-            except:
+                self._udp.sendto(datagram, (host, port))
+            except socket.error:
                 pass
 
+class BackendHealth(object):
+    """Latency, failures and list depth observed for one redis backend"""
+
+    def __init__(self, trans):
+        self.trans = trans
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = 0
+        self.depth = 0
+        self.depth_checked = 0
+        self.calls = 0
+        self.errors = 0
+
+    def success(self, latency):
+        self.calls += 1
+        self.failures = 0
+        self.ejected_until = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+
+    def failure(self, backoff, max_backoff):
+        """Ejects the backend, for twice as long after every consecutive failure"""
+        self.calls += 1
+        self.errors += 1
+        self.failures += 1
+        self.ejected_until = time.time() + min(max_backoff, backoff * 2 ** (self.failures - 1))
+
+    def weight(self):
+        # faster and emptier backends get a larger share of the batches
+        return 1.0 / max(self.latency or 0.01, 0.001) / (1.0 + self.depth / DEPTH_SCALE)
+
+    def stats(self):
+        return {
+            'redis_url': self.trans.redis_url,
+            'valid': self.trans.valid(),
+            'ejected': self.ejected_until > time.time(),
+            'latency_ms': round((self.latency or 0) * 1000, 1),
+            'depth': self.depth,
+            'calls': self.calls,
+            'errors': self.errors,
+        }
+
+
+# first back-off of a failed backend and its upper bound, in seconds
+BACKOFF = 1
+MAX_BACKOFF = 60
+
+# seconds between two LLEN of a backend
+DEPTH_INTERVAL = 5
+
+# list depth that halves the share of a backend
+DEPTH_SCALE = 10000.0
+
+
 class RedisTransports(object):
-    def __init__(self, redis_namespace, redis_urls, hostname, format=None, logger=None):
+    """
+        Sends every batch to one of the redis backends, chosen at random
+        weighted by their recent latency and list depth. A backend failing
+        with a TransportException is ejected and the messages it did not
+        push fail over to another one; an ejected backend is pinged again
+        after a back-off.
+    """
+
+    def __init__(self, redis_namespace, redis_urls, hostname, format=None, logger=None,
+                 backoff=BACKOFF, max_backoff=MAX_BACKOFF, es_options=None, **options):
         self._trans = []
         for redis_url in redis_urls:
-            self._trans.append(RedisTransport(redis_namespace, redis_url, hostname, format, logger))
+            self._trans.append(RedisTransport(redis_namespace, redis_url, hostname, format, logger, **options))
+
+        # ESBulkSink settings, workers = 0 keeps send_to_es synchronous
+        es_options = dict(es_options or {})
+        self.es_sink = None
+        if es_options.setdefault('workers', 2) > 0:
+            self.es_sink = ESBulkSink(**es_options)
+            for trans in self._trans:
+                trans.es_sink = self.es_sink
+        self._health = [BackendHealth(trans) for trans in self._trans]
+        self._logger = logger
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        metrics.collect(self._collect)
+
+    def _collect(self):
+        # the depth last seen, rendering must not wait for redis
+        for health in self._health:
+            metrics.set_gauge('queue_depth', health.depth,
+                              queue=health.trans._redis_namespace, backend=health.trans.redis_url)
+
+    def _available(self, health):
+        if health.ejected_until > time.time():
+            return False
+        if health.failures or not health.trans.valid():
+            # back-off is over, probe it before sending a batch
+            if not health.trans.probe():
+                health.failure(self.backoff, self.max_backoff)
+                return False
+        return True
 
-    def callback(self, *args, **kwargs):
-        trans = random.choice(self._trans)
+    def _update_depth(self, health):
+        if time.time() - health.depth_checked < DEPTH_INTERVAL:
+            return
+        health.depth_checked = time.time()
+        try:
+            health.depth = health.trans.depth()
+        except Exception:
+            pass
+
+    def _choose(self, tried):
+        candidates = [health for health in self._health
+                      if health not in tried and self._available(health)]
+        if not candidates:
+            return None
+
+        for health in candidates:
+            self._update_depth(health)
+
+        pick = random.uniform(0, sum(health.weight() for health in candidates))
+        for health in candidates:
+            pick -= health.weight()
+            if pick <= 0:
+                return health
+        return candidates[-1]
 
-        return trans.callback(*args, **kwargs)
+    def callback(self, filename, lines, **kwargs):
+        msgs = _raw(lines)
+        tried = []
+        while True:
+            health = self._choose(tried)
+            if not health:
+                raise TransportException("No redis backend available, tried %s"
+                                         % ', '.join(h.trans.redis_url for h in tried), msgs)
+
+            started = time.time()
+            try:
+                health.trans.push(msgs)
+            except TransportException, e:
+                health.failure(self.backoff, self.max_backoff)
+                health.trans.invalidate()
+                tried.append(health)
+                if self._logger:
+                    self._logger.warning("redis %s failed (%s) with %d of %d messages unsent, ejected for %ds",
+                                         health.trans.redis_url, e, len(e.unsent), len(msgs),
+                                         health.ejected_until - time.time())
+                msgs = e.unsent
+                continue
+
+            health.success(time.time() - started)
+            return
+
+    def flush(self):
+        """Waits until the batches handed to send_to_es are indexed"""
+        if self.es_sink:
+            self.es_sink.flush()
+
+    def stats(self):
+        """Returns the health of every backend"""
+        return [health.stats() for health in self._health]
+
+    def log_stats(self):
+        for stats in self.stats():
+            self._logger.info("redis %(redis_url)s: %(calls)d batches, %(errors)d errors, "
+                              "%(latency_ms).1fms, depth %(depth)d, valid %(valid)s, ejected %(ejected)s" % stats)
+        if self.es_sink:
+            self._logger.info("es: %(indexed)d docs indexed, %(dropped)d dropped, %(failed)d failed, "
+                              "%(retried)d retried, %(requests)d bulk requests, %(queued)d queued"
+                              % self.es_sink.stats())
 
     def send_to_es(self, *args, **kwargs):
         trans = random.choice(self._trans)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#coding=utf8
+"""
+    Relays Redis log lists to ES with a pool of processes.
+
+    Every (redis url, key) source gets at least one worker process
+    running fetch_ec2_log.FetchLog; extra processes are spread over the
+    sources. Workers which die are restarted, SIGTERM and SIGINT stop
+    them once their current batch is handled, and the aggregate
+    throughput is logged every --status_interval seconds.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+import config
+import metrics
+from es_sink import ESBulkSink
+from fetch_ec2_log import FetchLog, QUEUE_KEY, BATCH_SIZE, MAX_WAIT
+
+logger = logging.getLogger()
+
+STATUS_INTERVAL = 60
+
+# a worker dying again within RESTART_MAX seconds waits twice as long to restart
+RESTART_MIN = 1
+RESTART_MAX = 60
+
+
+def plan_workers(sources, processes):
+    """Returns the source of every worker, at least one worker per source"""
+    processes = max(processes, len(sources))
+    return [sources[i % len(sources)] for i in range(processes)]
+
+
+def _metrics_file(path, slot):
+    """relay.prom gives relay.<slot>.prom, a file per worker"""
+    base, ext = os.path.splitext(path)
+    return '%s.%d%s' % (base, slot, ext)
+
+
+def run_worker(slot, source, counts, options, es_options, metrics_port=None, metrics_file=None):
+    redis_url, key = source
+    metrics.REGISTRY.const_labels['worker'] = slot
+    metrics.start(metrics_port and metrics_port + slot, metrics_file and _metrics_file(metrics_file, slot))
+    es_sink = ESBulkSink(**dict(es_options, workers=max(1, es_options.get('workers', 2))))
+    relay = FetchLog(redis_url, key, es_sink=es_sink,
+                     worker_id='%s:%d' % (socket.gethostname(), os.getpid()), **options)
+
+    def stop(signum, frame):
+        relay.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # the count of the slot survives restarts, add to it
+    reported = [0]
+
+    def report():
+        consumed = relay.consumed
+        with counts.get_lock():
+            counts[slot] += consumed - reported[0]
+        reported[0] = consumed
+
+    def report_every_second():
+        while True:
+            time.sleep(1)
+            report()
+    t = threading.Thread(target=report_every_second)
+    t.daemon = True
+    t.start()
+
+    logger.info("Relaying %s %s", redis_url, key)
+    relay.run()
+    report()
+    logger.info("Stopped relaying %s %s", redis_url, key)
+
+
+class _Restarting(object):
+    """Stands for a dead worker until its restart is due"""
+
+    def __init__(self, at):
+        self.at = at
+
+    def due(self):
+        return time.time() >= self.at
+
+    def is_alive(self):
+        return False
+
+
+class Supervisor(object):
+    """Starts a worker process per slot and restarts the ones which die"""
+
+    def __init__(self, sources, processes, status_interval=STATUS_INTERVAL, es_options=None,
+                 metrics_port=None, metrics_file=None, **options):
+        self.slots = plan_workers(sources, processes)
+        self.status_interval = status_interval
+        self.es_options = es_options or {}
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.options = options
+        self.counts = multiprocessing.Array('L', len(self.slots))
+        self.workers = [None] * len(self.slots)
+        self._started = [0] * len(self.slots)
+        self._restart_wait = [RESTART_MIN] * len(self.slots)
+        self._stopping = False
+
+    def _start(self, slot):
+        p = multiprocessing.Process(target=run_worker,
+                                    args=(slot, self.slots[slot], self.counts, self.options, self.es_options,
+                                          self.metrics_port, self.metrics_file))
+        p.start()
+        self.workers[slot] = p
+        self._started[slot] = time.time()
+
+    def _check(self, slot):
+        p = self.workers[slot]
+        if p.is_alive():
+            return
+        if time.time() - self._started[slot] < RESTART_MAX:
+            wait = self._restart_wait[slot]
+            self._restart_wait[slot] = min(RESTART_MAX, wait * 2)
+        else:
+            wait = self._restart_wait[slot] = RESTART_MIN
+        logger.error("Worker of %s %s exited with %s, restarting it in %ds",
+                     self.slots[slot][0], self.slots[slot][1], p.exitcode, wait)
+        self.workers[slot] = _Restarting(time.time() + wait)
+
+    def stop(self, signum=None, frame=None):
+        if not self._stopping:
+            logger.info("Stopping %d workers", len(self.workers))
+        self._stopping = True
+        for p in self.workers:
+            if isinstance(p, multiprocessing.Process) and p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(len(self.slots)):
+            self._start(slot)
+
+        logged = time.time()
+        last_total = 0
+        while True:
+            time.sleep(1)
+            if self._stopping:
+                alive = [p for p in self.workers if p.is_alive()]
+                if not alive:
+                    break
+                continue
+
+            for slot, p in enumerate(self.workers):
+                if isinstance(p, _Restarting):
+                    if p.due():
+                        self._start(slot)
+                else:
+                    self._check(slot)
+
+            if time.time() - logged >= self.status_interval:
+                total = sum(self.counts)
+                logger.info("%d workers, %d docs relayed, %.1f docs/s", len(self.workers), total,
+                            (total - last_total) / (time.time() - logged))
+                logged = time.time()
+                last_total = total
+
+        for p in self.workers:
+            if isinstance(p, multiprocessing.Process):
+                p.join()
+        logger.info("Relayed %d docs", sum(self.counts))
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(process)d - %(levelname)s - %(message)s')
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis_url", action='append',
+                        help="redis holding the log lists, may be repeated, default is redis://127.0.0.1")
+
+    parser.add_argument("--key", action='append',
+                        help="redis list of logs, may be repeated, default is %s" % QUEUE_KEY)
+
+    parser.add_argument("--gae_config",
+                        help="relay the namespace list of the redis_urls of this fetcher config too")
+
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes, at least one per source, default is the number of cores")
+
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="messages taken from redis per cycle, default is %d" % BATCH_SIZE)
+
+    parser.add_argument("--max_wait", type=float, default=MAX_WAIT,
+                        help="seconds a cycle may wait to fill a batch, default is %s" % MAX_WAIT)
+
+    parser.add_argument("--reliable", action='store_true',
+                        help="keep messages in a processing list until ES has handled them")
+
+    parser.add_argument("--status_interval", type=int, default=STATUS_INTERVAL,
+                        help="seconds between two throughput logs, default is %d" % STATUS_INTERVAL)
+
+    parser.add_argument("--metrics_port", type=int,
+                        help="worker n serves Prometheus metrics on http://127.0.0.1:<port + n>/metrics")
+
+    parser.add_argument("--metrics_file",
+                        help="worker n writes Prometheus metrics to <file>.<n>.<ext> every %ds" % metrics.EXPORT_INTERVAL)
+
+    args = parser.parse_args()
+
+    sources = []
+    es_options = {}
+    if args.gae_config:
+        settings = config.read_config(args.gae_config)
+        redis_namespace, redis_urls, es_options = settings[2], settings[3], settings[5]
+        sources.extend((redis_url, redis_namespace) for redis_url in redis_urls)
+    if args.redis_url or args.key or not sources:
+        sources.extend((redis_url, key) for redis_url in args.redis_url or ['redis://127.0.0.1']
+                       for key in args.key or [QUEUE_KEY])
+
+    supervisor = Supervisor(sources, args.processes, args.status_interval, es_options=es_options,
+                            metrics_port=args.metrics_port, metrics_file=args.metrics_file,
+                            batch_size=args.batch_size, max_wait=args.max_wait, reliable=args.reliable)
+    supervisor.run()
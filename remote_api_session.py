@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext.remote_api import remote_api_stub
+from google.appengine.api.logservice import logservice
+from google.appengine.ext.remote_api.remote_api_stub import ConfigurationError
+
+import metrics
+
+logger = logging.getLogger()
+
+# access tokens are valid for an hour, reconfigure a bit before that
+TOKEN_MAX_AGE = 50 * 60
+
+# errors after which the stub is configured again on the next fetch
+RECONFIGURE_ERRORS = (ConfigurationError, urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+# the apiproxy stub map and APPLICATION_ID are process wide, so configuring
+# the stub of one app must not interleave with the others
+_configure_lock = threading.Lock()
+
+
+class _LogServiceRouter(object):
+    """
+        Registered as the logservice stub of the process, it sends every
+        call to the stub of the app the calling thread is fetching for
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def use(self, stub, app_id):
+        self._local.stub = stub
+        self._local.app_id = app_id
+
+    def MakeSyncCall(self, service, call, request, response):
+        # logservice.fetch takes the app id from os.environ, which holds
+        # whichever app was configured last
+        if hasattr(request, 'set_app_id'):
+            request.set_app_id(self._local.app_id)
+        self._local.stub.MakeSyncCall(service, call, request, response)
+
+
+_router = _LogServiceRouter()
+
+
+class RemoteApiSession(object):
+    """
+        Configures the remote_api stub of an app once and reuses it for
+        every fetch until the token gets old or a fetch fails with an
+        auth or transport error. Sessions of several apps can fetch from
+        the same process at the same time.
+    """
+
+    def __init__(self, app_name, path='/remote_api', max_age=TOKEN_MAX_AGE):
+        self.app_name = app_name
+        self.path = path
+        self.max_age = max_age
+        self._configured_at = None
+        self._stub = None
+        self._app_id = None
+        self._lock = threading.Lock()
+        self._stats = {'configurations': 0, 'setup_s': 0.0, 'fetches': 0, 'fetch_s': 0.0}
+
+    def ensure(self):
+        """Configures the stub unless a fresh configuration is cached"""
+        with self._lock:
+            if self._configured_at and time.time() - self._configured_at < self.max_age:
+                return
+
+            started = time.time()
+            with _configure_lock:
+                os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '%s.json' % self.app_name
+                remote_api_stub.ConfigureRemoteApiForOAuth(self.app_name + '.appspot.com', self.path)
+                self._stub = apiproxy_stub_map.apiproxy.GetStub('logservice')
+                self._app_id = os.environ['APPLICATION_ID']
+                apiproxy_stub_map.apiproxy.ReplaceStub('logservice', _router)
+            self._configured_at = time.time()
+            self._stats['configurations'] += 1
+            self._stats['setup_s'] += self._configured_at - started
+
+        logger.info("Configured remote_api for %s in %.2fs", self.app_name, self._configured_at - started)
+
+    def invalidate(self):
+        """Forces a new configuration before the next fetch"""
+        with self._lock:
+            self._configured_at = None
+
+    def fetch(self, **kwargs):
+        """Wraps logservice.fetch, timing the retrieval of request logs"""
+        self.ensure()
+        req_logs = iter(self._fetch(**kwargs))
+        fetch_s = 0
+        try:
+            while True:
+                started = time.time()
+                _router.use(self._stub, self._app_id)
+                try:
+                    req_log = next(req_logs)
+                except StopIteration:
+                    return
+                finally:
+                    fetch_s += time.time() - started
+                yield req_log
+        except RECONFIGURE_ERRORS as e:
+            logger.warning("remote_api for %s failed, it will be configured again", self.app_name)
+            metrics.inc('errors_total', stage='gae', type=e.__class__.__name__)
+            self.invalidate()
+            raise
+        finally:
+            self._add('fetch_s', fetch_s)
+            self._add('fetches', 1)
+            # time spent waiting for logservice, without the consumer's
+            metrics.observe('stage_seconds', fetch_s, stage='gae')
+
+    def _fetch(self, **kwargs):
+        return logservice.fetch(**kwargs)
+
+    def _add(self, key, value):
+        with self._lock:
+            self._stats[key] += value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info("remote_api %s: %d configurations took %.1fs, %d fetches took %.1fs",
+                    self.app_name, stats['configurations'], stats['setup_s'],
+                    stats['fetches'], stats['fetch_s'])
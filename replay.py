@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#coding=utf8
+"""
+    Sends archived logs again, without fetching them from GAE.
+
+    Reads the json_event archives written by fetcher.py --save_to_file
+    for a time range and sends them to Redis, or to ES with --send_to_es,
+    at most --rate req logs per second. --readers threads decompress and
+    decode the archive files while the main thread sends:
+
+        python replay.py --archive_dir /mnt/gae_logs --start_timestamp 1380610800 --end_timestamp 1380697200 --send_to_es
+"""
+import argparse
+import logging
+import Queue
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+import archive
+import config
+from redis_transport import RedisTransports
+
+logger = logging.getLogger()
+
+# req logs per callback or send_to_es
+CHUNK_RECORDS = config.MAX_BUFFER_RECORDS
+
+# chunks decoded ahead of the sender
+READ_AHEAD = 8
+
+
+def plan_files(directory, app_names, start, end):
+    """Returns the (dest, index name, archive path) of the files which may hold logs of [start, end)"""
+    # an interval starting the day before may hold logs of the first day
+    day = datetime.fromtimestamp(start, tz=config.GAE_TZ).date() - timedelta(days=1)
+    last = datetime.fromtimestamp(end - 1, tz=config.GAE_TZ).date()
+    files = []
+    while day <= last:
+        for app_name in app_names:
+            dest = '%s-%s.log' % (app_name, day.strftime('%Y-%m-%d'))
+            for path in archive.archive_files(directory, archive.event_name(dest)):
+                files.append((dest, day.strftime('%Y.%m.%d'), path))
+        day += timedelta(days=1)
+    return files
+
+
+class RateLimiter(object):
+    """Sleeps so that at most rate records per second get through, 0 is no limit"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.time()
+        self.records = 0
+
+    def wait(self, records):
+        self.records += records
+        if self.rate:
+            ahead = self.records / float(self.rate) - (time.time() - self.started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def _read(files, chunks, start, end, chunk_records):
+    """Reader thread, puts (dest, index name, lines) chunks on chunks and None once done"""
+    try:
+        while True:
+            try:
+                dest, index_name, path = files.get_nowait()
+            except Queue.Empty:
+                return
+            lines = []
+            for line in archive.iter_lines(path, start, end):
+                lines.append(line)
+                if len(lines) >= chunk_records:
+                    chunks.put((dest, index_name, lines))
+                    lines = []
+            if lines:
+                chunks.put((dest, index_name, lines))
+    except Exception:
+        logger.error("Reading the archive failed", exc_info=True)
+    finally:
+        chunks.put(None)
+
+
+def replay(directory, app_names, start, end, redis_transports, send_to_es=False, rate=0, readers=2,
+           chunk_records=CHUNK_RECORDS):
+    """
+        Sends the archived logs of [start, end) and returns their number
+        along with the number of them ES failed on or dropped
+    """
+    files = Queue.Queue()
+    paths = plan_files(directory, app_names, start, end)
+    for path in paths:
+        files.put(path)
+    logger.info("Replaying %s - %s from %d files",
+                datetime.fromtimestamp(start, tz=config.GAE_TZ),
+                datetime.fromtimestamp(end, tz=config.GAE_TZ), len(paths))
+
+    chunks = Queue.Queue(READ_AHEAD)
+    for _ in range(readers):
+        t = threading.Thread(target=_read, args=(files, chunks, start, end, chunk_records))
+        t.daemon = True
+        t.start()
+
+    # counted by the ES sink threads once ES handled a chunk
+    es_counts = {'indexed': 0, 'dropped': 0, 'failed': 0}
+    es_lock = threading.Lock()
+
+    def done(indexed, dropped, failed):
+        with es_lock:
+            es_counts['indexed'] += indexed
+            es_counts['dropped'] += len(dropped)
+            es_counts['failed'] += failed
+
+    limiter = RateLimiter(rate)
+    logged = time.time()
+    records = 0
+    running = readers
+    while running:
+        chunk = chunks.get()
+        if chunk is None:
+            running -= 1
+            continue
+
+        dest, index_name, lines = chunk
+        limiter.wait(len(lines))
+        if send_to_es:
+            redis_transports.send_to_es(index_name, dest, lines, done=done)
+        else:
+            redis_transports.callback(dest, lines)
+        records += len(lines)
+
+        if time.time() - logged > config.STATUS_INTERVAL:
+            logger.info("Replayed %d req logs, %.1f req logs/s", records, records / (time.time() - limiter.started))
+            logged = time.time()
+
+    redis_transports.flush()
+    redis_transports.log_stats()
+    logger.info("Replayed %d req logs in %ds", records, time.time() - limiter.started)
+    failed = es_counts['dropped'] + es_counts['failed']
+    if failed:
+        logger.error("ES dropped %(dropped)d and failed on %(failed)d of the req logs", es_counts)
+    return records, failed
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive_dir", required=True,
+                        help="directory of the archives written by --save_to_file")
+
+    parser.add_argument("--start_timestamp", type=int, required=True)
+
+    parser.add_argument("--end_timestamp", type=int, required=True)
+
+    parser.add_argument("--gae_config",
+                        help="Config file for GAE user, pass, app. If not specified, it looks for fetcher.conf")
+
+    parser.add_argument("--app", action='append',
+                        help="app to replay, may be repeated, default is every app of the config")
+
+    parser.add_argument("--send_to_es",
+                        help="dir send to es", action='store_true')
+
+    parser.add_argument("--rate", type=int, default=0,
+                        help="max req logs sent per second, default is no limit")
+
+    parser.add_argument("--readers", type=int, default=2,
+                        help="number of threads reading the archives, default is 2")
+
+    args = parser.parse_args()
+
+    conf = args.gae_config or 'fetcher.conf'
+    app_names, version_ids, redis_namespace, redis_urls, redis_options, es_options, udp_host, udp_port = config.read_config(conf)
+    redis_transports = RedisTransports(redis_namespace, redis_urls, hostname='%s.appspot.com' % app_names[0],
+                                       format='raw', logger=logger, es_options=es_options, **redis_options)
+
+    records, failed = replay(args.archive_dir, args.app or app_names, args.start_timestamp, args.end_timestamp,
+                             redis_transports, send_to_es=args.send_to_es, rate=args.rate, readers=args.readers)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import json
+
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
+ENCODING = "ISO-8859-1"
+
+# callers decode byte strings with _text, ujson would take them as utf-8
+if fast_json:
+    def fast_dumps(value):
+        return fast_json.dumps(value)
+else:
+    fast_dumps = json.JSONEncoder(encoding=ENCODING).encode
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode(ENCODING)
+    return value
+
+
+def dumps(data):
+    """Encodes any data the way the raw formatter always did"""
+    return json.dumps(data, encoding=ENCODING)
+
+
+class ESSerializer(object):
+    """Serializer for the Elasticsearch client using the fast backend when installed"""
+
+    mimetype = 'application/json'
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def dumps(self, data):
+        if isinstance(data, basestring):
+            return data
+        if fast_json:
+            return fast_json.dumps(data)
+        return json.dumps(data, ensure_ascii=False)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import logging
+import Queue
+import threading
+
+import metrics
+
+logger = logging.getLogger()
+
+# batches waiting for a sink before deliver blocks
+SINK_QUEUE = 16
+
+
+class SinkError(Exception):
+    pass
+
+
+class Delivery(object):
+    """
+        The sink calls of one chunk. done is set once every call returned,
+        or for the calls which hold it until their sink sent the chunk
+        (see hold), once they released it. failed counts the calls which
+        raised or released it with ok False. sent() is called once done
+        unless a call failed.
+    """
+
+    def __init__(self, sent=None):
+        self.failed = 0
+        self._sent = sent
+        self.done = threading.Event()
+        # released by seal, once every call is queued
+        self._pending = 1
+        self._lock = threading.Lock()
+
+    def hold(self):
+        """Keeps the delivery pending until the returned release(ok) is called"""
+        with self._lock:
+            self._pending += 1
+        return self._release
+
+    def _release(self, ok=True):
+        with self._lock:
+            self._pending -= 1
+            if not ok:
+                self.failed += 1
+            finished = not self._pending
+        if finished:
+            if self._sent and not self.failed:
+                self._sent()
+            self.done.set()
+
+    def seal(self):
+        """Marks the end of the calls of the chunk"""
+        self._release()
+
+
+class _SinkWorker(object):
+    """Runs the calls queued for one sink, in order, from its own thread"""
+
+    def __init__(self, name, queue_size):
+        self.name = name
+        self.errors = 0
+        self._queue = Queue.Queue(queue_size)
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+
+    def put(self, func, args, release=None):
+        self._queue.put((func, args, release))
+
+    def _work(self):
+        while True:
+            func, args, release = self._queue.get()
+            try:
+                with metrics.timer('stage_seconds', stage='sink_%s' % self.name):
+                    func(*args)
+            except:
+                self.errors += 1
+                logger.error("Sink %s failed", self.name, exc_info=True)
+                if release:
+                    release(False)
+            else:
+                if release:
+                    release(True)
+
+
+class SinkFanout(object):
+    """
+        Hands every batch to the sinks it goes to at once. Each sink has
+        a thread and a bounded queue, so a slow sink only holds back the
+        fetch once its own queue is full, while the others keep up. A
+        sink sees its batches in the order they were delivered, and a
+        Delivery tells when and whether every sink of a batch sent it.
+
+        Threads of one sink run one call at a time: fetchers sharing
+        their sinks (e.g. RedisTransports) must share the SinkFanout too.
+    """
+
+    def __init__(self, queue_size=SINK_QUEUE):
+        self.queue_size = queue_size
+        self._workers = {}
+        self._lock = threading.Lock()
+        metrics.collect(self._collect)
+
+    def _worker(self, name):
+        with self._lock:
+            worker = self._workers.get(name)
+            if not worker:
+                worker = self._workers[name] = _SinkWorker(name, self.queue_size)
+            return worker
+
+    def deliver(self, name, func, *args, **kwargs):
+        """
+            Queues func(*args) for the sink name, blocking while its queue
+            is full. The delivery keyword argument is held until it ran.
+        """
+        delivery = kwargs.get('delivery')
+        self._worker(name).put(func, args, delivery and delivery.hold())
+
+    def flush(self):
+        """Waits until every batch delivered so far has been handed to its sink"""
+        with self._lock:
+            workers = self._workers.values()
+        # a marker behind the batches, others may keep delivering meanwhile
+        markers = []
+        for worker in workers:
+            marker = threading.Event()
+            worker.put(marker.set, ())
+            markers.append(marker)
+        for marker in markers:
+            marker.wait()
+
+    def errors(self):
+        """Returns the number of batches the sinks failed to send"""
+        with self._lock:
+            return sum(worker.errors for worker in self._workers.values())
+
+    def stats(self):
+        with self._lock:
+            return dict((name, {'queued': worker._queue.qsize(), 'errors': worker.errors})
+                        for name, worker in self._workers.items())
+
+    def _collect(self):
+        for name, stats in self.stats().items():
+            metrics.set_gauge('queue_depth', stats['queued'], queue='sink_%s' % name)
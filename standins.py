@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+    Local stand-ins for the services around the pipeline, so that it can
+    be run end to end without GAE credentials or a cluster (bench.py):
+
+        FakeLogService  a logservice.fetch generating synthetic req logs
+        RedisServer     an in-memory redis speaking the protocol on a local
+                        port, with the list commands the pipeline uses
+        ESServer        a bulk endpoint on a local port accepting the docs,
+                        or rejecting or refusing some of them
+"""
+import BaseHTTPServer
+import SocketServer
+import fnmatch
+import json
+import random
+import threading
+import time
+
+# req logs logservice returns per round trip
+FETCH_BATCH = 20
+
+
+class _RequestLog(object):
+    """The attributes of logservice.RequestLog the fetcher reads"""
+
+    def __init__(self, i, end_time, app_logs, message_bytes):
+        self.request_id = '%016x' % i
+        self.offset = str(i)
+        self.end_time = end_time
+        self.status = (200, 200, 200, 200, 302, 404, 500)[i % 7]
+        self.latency = 0.01 + (i % 100) * 0.005
+        path = self.resource = '/api/v1/items/%d' % i
+        combined = '10.0.%d.%d - - [01/Oct/2013:00:00:00 -0700] "GET %s HTTP/1.1" %d 1234 - "Mozilla/5.0"' % (
+            i // 256 % 256, i % 256, path, self.status)
+        self.combined = combined + ' ' + 'x' * max(0, message_bytes - len(combined) - 1)
+        self.app_logs = [_AppLog(end_time - self.latency + j * 0.001, j % 5 and 1 or 3,
+                                 'handled %s step %d' % (path, j))
+                         for j in range(app_logs)]
+
+
+class _AppLog(object):
+
+    def __init__(self, time, level, message):
+        self.time = time
+        self.level = level
+        self.message = message
+
+
+class FakeLogService(object):
+    """
+        Generates rate req logs per second of log time, each with a
+        combined line of about message_bytes and app_logs app log lines.
+        Every round trip of FETCH_BATCH req logs takes fetch_ms.
+    """
+
+    def __init__(self, rate=1000, app_logs=5, message_bytes=200, fetch_ms=0):
+        self.rate = rate
+        self.app_logs = app_logs
+        self.message_bytes = message_bytes
+        self.fetch_ms = fetch_ms
+
+    def fetch(self, start_time=None, end_time=None, offset=None, **kwargs):
+        first = int(start_time * self.rate)
+        if offset:
+            first = int(offset) + 1
+        for i in xrange(first, int(end_time * self.rate)):
+            if self.fetch_ms and (i - first) % FETCH_BATCH == 0:
+                time.sleep(self.fetch_ms / 1000.0)
+            yield _RequestLog(i, i / float(self.rate), self.app_logs, self.message_bytes)
+
+
+def _serve(server):
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _index(n, i):
+    """A redis list index, which may be negative, as a python one"""
+    return i + n if i < 0 else i
+
+
+class _RedisHandler(SocketServer.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        queued = None
+        while True:
+            args = self._read()
+            if args is None:
+                return
+            command = args[0].upper()
+            if command == 'MULTI':
+                queued = []
+                reply = 'OK'
+            elif command == 'EXEC':
+                reply = [self.server.redis.call(a[0].upper(), a[1:]) for a in queued or []]
+                queued = None
+            elif queued is not None:
+                queued.append(args)
+                reply = 'QUEUED'
+            else:
+                reply = self.server.redis.call(command, args[1:])
+            self.wfile.write(_encode(reply))
+            self.wfile.flush()
+
+    def _read(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+
+def _encode(reply):
+    if reply is None:
+        return '$-1\r\n'
+    if isinstance(reply, bool) or isinstance(reply, (int, long)):
+        return ':%d\r\n' % reply
+    if isinstance(reply, list):
+        return '*%d\r\n%s' % (len(reply), ''.join(_encode(item) for item in reply))
+    if isinstance(reply, Exception):
+        return '-ERR %s\r\n' % reply
+    if reply in ('OK', 'QUEUED', 'PONG'):
+        return '+%s\r\n' % reply
+    return '$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+class RedisServer(object):
+    """In-memory lists and keys served on 127.0.0.1:port, 0 picks a free port"""
+
+    def __init__(self, port=0):
+        self._lists = {}
+        self._keys = {}
+        self._changed = threading.Condition()
+        self._server = _ThreadingTCPServer(('127.0.0.1', port), _RedisHandler)
+        self._server.redis = self
+        self.url = 'redis://127.0.0.1:%d' % self._server.server_address[1]
+        _serve(self._server)
+
+    def shutdown(self):
+        """Stops serving, new connections are refused"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def call(self, command, args):
+        method = getattr(self, '_' + command.lower(), None)
+        if not method:
+            return Exception('unknown command %s' % command)
+        with self._changed:
+            return method(*args)
+
+    def _wait(self, timeout, ready):
+        deadline = time.time() + (float(timeout) or 3600)
+        while not ready() and time.time() < deadline:
+            self._changed.wait(deadline - time.time())
+        return ready()
+
+    def _ping(self):
+        return 'PONG'
+
+    def _select(self, db):
+        return 'OK'
+
+    def _rpush(self, key, *values):
+        items = self._lists.setdefault(key, [])
+        items.extend(values)
+        self._changed.notify_all()
+        return len(items)
+
+    def _lpush(self, key, *values):
+        items = self._lists.setdefault(key, [])
+        items[:0] = reversed(values)
+        self._changed.notify_all()
+        return len(items)
+
+    def _llen(self, key):
+        return len(self._lists.get(key, ()))
+
+    def _lrange(self, key, start, stop):
+        items = self._lists.get(key, [])
+        start, stop = _index(len(items), int(start)), _index(len(items), int(stop))
+        return items[max(start, 0):stop + 1]
+
+    def _ltrim(self, key, start, stop):
+        items = self._lists.get(key, [])
+        start, stop = _index(len(items), int(start)), _index(len(items), int(stop))
+        items[:] = items[max(start, 0):stop + 1]
+        return 'OK'
+
+    def _rpop(self, key):
+        items = self._lists.get(key)
+        return items.pop() if items else None
+
+    def _rpoplpush(self, source, destination):
+        value = self._rpop(source)
+        if value is not None:
+            self._lpush(destination, value)
+        return value
+
+    def _brpop(self, *args):
+        keys, timeout = args[:-1], args[-1]
+        if not self._wait(timeout, lambda: any(self._lists.get(key) for key in keys)):
+            return None
+        key = [key for key in keys if self._lists.get(key)][0]
+        return [key, self._rpop(key)]
+
+    def _brpoplpush(self, source, destination, timeout):
+        if not self._wait(timeout, lambda: self._lists.get(source)):
+            return None
+        return self._rpoplpush(source, destination)
+
+    def _setex(self, key, ttl, value):
+        self._keys[key] = (value, time.time() + int(ttl))
+        return 'OK'
+
+    def _exists(self, *keys):
+        return sum(1 for key in keys if key in self._lists and self._lists[key] or
+                   key in self._keys and self._keys[key][1] > time.time())
+
+    def _delete(self, *keys):
+        deleted = self._exists(*keys)
+        for key in keys:
+            self._lists.pop(key, None)
+            self._keys.pop(key, None)
+        return deleted
+
+    _del = _delete
+
+    def _scan(self, cursor, *args):
+        options = dict(zip(args[::2], args[1::2]))
+        pattern = options.get('MATCH', options.get('match', '*'))
+        keys = [key for key, items in self._lists.items() if items] + list(self._keys)
+        return ['0', [key for key in keys if fnmatch.fnmatchcase(key, pattern)]]
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ESHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    # a response in one write, flushed once handled
+    wbufsize = -1
+
+    def _reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply({'version': {'number': '1.7.0'}, 'tagline': 'You Know, for Search'})
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        docs = body.count('\n') // 2
+        self.server.es.indexed(docs, len(body))
+        # rejections exercise the retries of ESBulkSink
+        items = [{'index': {'status': self.server.es.status()}} for _ in range(docs)]
+        self._reply({'took': 1, 'errors': any(item['index']['status'] != 201 for item in items), 'items': items})
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class ESServer(object):
+    """
+        A bulk endpoint on 127.0.0.1:port rejecting reject_rate of the
+        docs with 429 and refusing drop_rate of them with 400
+    """
+
+    def __init__(self, port=0, reject_rate=0, drop_rate=0):
+        self.reject_rate = reject_rate
+        self.drop_rate = drop_rate
+        self.docs = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(('127.0.0.1', port), _ESHandler)
+        self._server.es = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        _serve(self._server)
+
+    def status(self):
+        """The status of the next doc"""
+        draw = random.random()
+        if draw < self.reject_rate:
+            return 429
+        if draw < self.reject_rate + self.drop_rate:
+            return 400
+        return 201
+
+    def indexed(self, docs, size):
+        with self._lock:
+            self.docs += docs
+            self.bytes += size
+
+    def shutdown(self):
+        self._server.shutdown()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+import archive
+from archive import ArchiveWriter, archive_files, iter_lines, read_index
+from record import LogRecord
+
+
+def _records(start, n, step=1.0):
+    return [LogRecord('app-gae', '2013-10-01T00:00:%02d' % (i % 60), 'line %d' % i, 200, 10,
+                      start + i * step, 'production', id='req%d' % i)
+            for i in range(n)]
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.member_s = archive.MEMBER_S
+        archive.MEMBER_S = 60
+
+    def tearDown(self):
+        archive.MEMBER_S = self.member_s
+        shutil.rmtree(self.directory)
+
+    def test_events_round_trip(self):
+        writer = ArchiveWriter(self.directory)
+        records = _records(1380610800, 100)
+        writer.write_lines('app-2013-10-01.log', records)
+        writer.close()
+
+        path = osp.join(self.directory, 'app-2013-10-01.json.gz')
+        read = list(iter_lines(path))
+        self.assertEqual([record.raw() for record in read], [record.raw() for record in records])
+        # a gzip reader sees one stream
+        self.assertEqual(len(gzip.open(path).read().splitlines()), 100)
+
+    def test_members_cover_a_time_range(self):
+        writer = ArchiveWriter(self.directory)
+        writer.write_lines('app-2013-10-01.log', _records(1380610800, 300))
+        writer.close()
+
+        path = osp.join(self.directory, 'app-2013-10-01.json.gz')
+        members = read_index(path)
+        self.assertEqual(len(members), 5)
+        self.assertEqual(sum(member[4] for member in members), 300)
+        read = list(iter_lines(path, 1380610800 + 100, 1380610800 + 130))
+        self.assertEqual([record.id for record in read], ['req%d' % i for i in range(100, 130)])
+
+    def test_text_format(self):
+        writer = ArchiveWriter(self.directory, compression='none', format='text')
+        writer.write_lines('app-2013-10-01.log', _records(1380610800, 3))
+        writer.close()
+        with open(osp.join(self.directory, 'app-2013-10-01.log')) as f:
+            self.assertEqual(f.read(), 'line 0\nline 1\nline 2\n')
+
+    def test_rotation_and_writers(self):
+        for suffix in (None, 'p12'):
+            writer = ArchiveWriter(self.directory, rotate_bytes=1, suffix=suffix)
+            for records in (_records(1380610800, 2), _records(1380610900, 2)):
+                writer.write_lines('app-2013-10-01.log', records)
+            writer.close()
+        writer = ArchiveWriter(self.directory)
+        writer.write_lines('other-2013-10-01.log', _records(1380610800, 1))
+        writer.close()
+
+        paths = archive_files(self.directory, 'app-2013-10-01.json')
+        self.assertEqual([osp.basename(path) for path in paths],
+                         ['app-2013-10-01.json.gz', 'app-2013-10-01.1.json.gz',
+                          'app-2013-10-01.p12.json.gz', 'app-2013-10-01.p12.1.json.gz'])
+        self.assertEqual(sum(len(list(iter_lines(path))) for path in paths), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
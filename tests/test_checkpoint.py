@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os.path as osp
+import shutil
+import tempfile
+import unittest
+
+from checkpoint import CheckpointStore, checkpoint_key
+
+
+class CheckpointStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = osp.join(self.directory, 'checkpoints')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        self.assertEqual(checkpoint_key('app', ['1', '2']), 'app:1,2')
+
+    def test_resumes_from_the_store(self):
+        store = CheckpointStore(self.path)
+        store.set('app:1', 1380610800, end=1380610810, offset='abc')
+        store.flush()
+
+        entry = CheckpointStore(self.path).get('app:1')
+        self.assertEqual((entry['timestamp'], entry['end'], entry['offset']), (1380610800, 1380610810, 'abc'))
+
+    def test_writes_are_batched(self):
+        flushes = []
+        store = CheckpointStore(self.path, flush_interval=3600, before_flush=lambda: flushes.append(1))
+        store.set('app:1', 1380610800)
+        store.set('app:1', 1380610810)
+        self.assertEqual(flushes, [1])
+        self.assertEqual(CheckpointStore(self.path).get('app:1')['timestamp'], 1380610800)
+
+        store.flush()
+        self.assertEqual(flushes, [1, 1])
+        self.assertEqual(CheckpointStore(self.path).get('app:1')['timestamp'], 1380610810)
+
+    def test_stores_keep_the_keys_of_each_other(self):
+        first, second = CheckpointStore(self.path), CheckpointStore(self.path)
+        first.set('app:1', 1380610800)
+        first.flush()
+        second.set('other:1', 1380610900)
+        second.flush()
+        first.set('app:1', 1380611000)
+        first.flush()
+
+        store = CheckpointStore(self.path)
+        self.assertEqual(store.get('app:1')['timestamp'], 1380611000)
+        self.assertEqual(store.get('other:1')['timestamp'], 1380610900)
+        self.assertEqual(first.get('other:1')['timestamp'], 1380610900)
+
+    def test_failed_flush_keeps_the_updates(self):
+        def fail():
+            raise IOError('sinks failed')
+        store = CheckpointStore(self.path, flush_interval=3600, before_flush=fail)
+        self.assertRaises(IOError, store.set, 'app:1', 1380610800)
+        store.before_flush = None
+        store.flush()
+        self.assertEqual(CheckpointStore(self.path).get('app:1')['timestamp'], 1380610800)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from dedup import BloomFilter, SeenSet, event_id
+from record import LogRecord
+
+
+def _record(id, end_time):
+    return LogRecord('app-gae', '2013-10-01T00:00:00', 'line', 200, 10, end_time, 'production', id=id)
+
+
+class EventIdTest(unittest.TestCase):
+
+    def test_same_req_log_same_id(self):
+        self.assertEqual(event_id('abc', 1380610800.123456), event_id(u'abc', 1380610800.123456))
+
+    def test_end_time_changes_the_id(self):
+        self.assertNotEqual(event_id('abc', 1380610800.123456), event_id('abc', 1380610800.123457))
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for i in range(1000):
+            bloom.add('id%d' % i)
+        self.assertTrue(all('id%d' % i in bloom for i in range(1000)))
+        self.assertEqual(bloom.count, 1000)
+
+    def test_few_false_positives(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('id%d' % i)
+        false_positives = sum(1 for i in range(10000) if 'other%d' % i in bloom)
+        self.assertTrue(false_positives < 300)
+
+
+class SeenSetTest(unittest.TestCase):
+
+    def test_filter_does_not_remember(self):
+        seen = SeenSet(100)
+        records = [_record('id%d' % i, 100.0) for i in range(10)]
+        self.assertEqual(seen.filter(records), records)
+        self.assertEqual(seen.filter(records), records)
+        self.assertEqual(seen.dropped, 0)
+
+    def test_drops_the_ids_sent(self):
+        seen = SeenSet(100)
+        records = [_record('id%d' % i, 100.0) for i in range(10)]
+        seen.update(records[:6])
+        self.assertEqual(seen.filter(records), records[6:])
+        self.assertEqual(seen.dropped, 6)
+
+    def test_records_without_id_pass(self):
+        seen = SeenSet(100)
+        records = [_record(None, 100.0)]
+        seen.update(records)
+        self.assertEqual(seen.filter(records), records)
+
+    def test_old_buckets_are_forgotten(self):
+        seen = SeenSet(100, bucket_s=10, buckets=2)
+        old, middle, new = _record('a', 5), _record('b', 15), _record('c', 25)
+        seen.update([old, middle, new])
+        self.assertEqual(seen.filter([old, middle, new]), [old])
+        self.assertEqual(seen.stats()['buckets'], 2)
+
+    def test_full_bucket_grows_a_filter(self):
+        seen = SeenSet(10)
+        records = [_record('id%d' % i, 100.0) for i in range(25)]
+        seen.update(records)
+        self.assertEqual(seen.stats()['filters'], 3)
+        self.assertEqual(seen.filter(records), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
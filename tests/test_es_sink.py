@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+
+from elasticsearch import Elasticsearch
+
+import es_sink
+from es_sink import ESBulkSink
+from standins import ESServer
+
+
+def _actions(n):
+    return [{'_index': 'logstash-2013.10.01', '_type': 'app-gae', '_id': 'req%d' % i,
+             '_source': '{"@message": "line %d"}' % i}
+            for i in range(n)]
+
+
+class ESBulkSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backoff = es_sink.BACKOFF
+        es_sink.BACKOFF = 0.001
+        self.servers = []
+
+    def tearDown(self):
+        es_sink.BACKOFF = self.backoff
+        for server in self.servers:
+            server.shutdown()
+
+    def _sink(self, url=None, **options):
+        if not url:
+            server = ESServer(reject_rate=options.pop('reject_rate', 0), drop_rate=options.pop('drop_rate', 0))
+            self.servers.append(server)
+            url = server.url
+        return ESBulkSink(Elasticsearch([url], max_retries=0), **options)
+
+    def test_indexes_every_action(self):
+        sink = self._sink(max_chunk_docs=100)
+        sink.put_many(_actions(1000))
+        sink.flush()
+        stats = sink.stats()
+        self.assertEqual(stats['indexed'], 1000)
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(self.servers[0].docs, 1000)
+
+    def test_partial_chunk_is_not_held_back(self):
+        sink = self._sink()
+        sink.put_many(_actions(5))
+        started = time.time()
+        sink.flush()
+        self.assertTrue(time.time() - started < 0.5, time.time() - started)
+        self.assertEqual(sink.stats()['indexed'], 5)
+
+    def test_retries_rejected_items(self):
+        sink = self._sink(reject_rate=0.3, max_chunk_docs=100, max_retries=30)
+        sink.put_many(_actions(1000))
+        sink.flush()
+        stats = sink.stats()
+        self.assertEqual(stats['indexed'], 1000)
+        self.assertTrue(stats['retried'] > 0)
+        # only the rejected items are sent again
+        self.assertEqual(self.servers[0].docs, 1000 + stats['retried'])
+
+    def test_done_once_flushed(self):
+        sink = self._sink(max_chunk_docs=50)
+        results = []
+        sink.put_many(_actions(120), done=lambda *args: results.append(args))
+        sink.put_many(_actions(30), done=lambda *args: results.append(args))
+        sink.flush()
+        self.assertEqual(sorted(results), [(30, [], 0), (120, [], 0)])
+
+    def test_done_without_actions(self):
+        results = []
+        self._sink().put_many([], done=lambda *args: results.append(args))
+        self.assertEqual(results, [(0, [], 0)])
+
+    def test_refused_items_are_dropped(self):
+        sink = self._sink(drop_rate=1)
+        results = []
+        sink.put_many(_actions(3), done=lambda *args: results.append(args))
+        sink.flush()
+        indexed, dropped, failed = results[0]
+        self.assertEqual((indexed, failed), (0, 0))
+        self.assertEqual(sorted(dropped), ['{"@message": "line %d"}' % i for i in range(3)])
+        self.assertEqual(sink.stats()['dropped'], 3)
+
+    def test_items_rejected_after_retries_fail(self):
+        sink = self._sink(reject_rate=1, max_retries=2)
+        results = []
+        sink.put_many(_actions(5), done=lambda *args: results.append(args))
+        sink.flush()
+        self.assertEqual(results, [(0, [], 5)])
+        self.assertEqual(sink.stats()['retried'], 10)
+
+    def test_unreachable_es_fails_and_sets_down(self):
+        sink = self._sink('http://127.0.0.1:1', max_retries=1)
+        results = []
+        sink.put_many(_actions(5), done=lambda *args: results.append(args))
+        sink.flush()
+        self.assertEqual(results, [(0, [], 5)])
+        self.assertTrue(sink.down.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
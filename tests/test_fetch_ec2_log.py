@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import threading
+import time
+import unittest
+
+import redis
+from elasticsearch import Elasticsearch
+
+import es_sink
+import fetch_ec2_log
+from es_sink import ESBulkSink
+from fetch_ec2_log import FetchLog
+from standins import ESServer, RedisServer
+
+KEY = 'ec2_log'
+
+
+def _msgs(n):
+    return [json.dumps({'@type': 'app', '@timestamp': '2013-10-01T00:00:00Z', '@fields': {'i': i}})
+            for i in range(n)]
+
+
+class _Sink(object):
+    """ESBulkSink keeping the done callbacks, for the test to call"""
+
+    def __init__(self):
+        self.es = Elasticsearch(['http://127.0.0.1:1'], max_retries=0)
+        self.down = threading.Event()
+        self.done = []
+
+    def put_many(self, actions, done=None):
+        self.done.append(done)
+
+    def flush(self):
+        pass
+
+
+class ReliableRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backoff, self.es_down_wait = es_sink.BACKOFF, fetch_ec2_log.ES_DOWN_WAIT
+        es_sink.BACKOFF = 0.01
+        fetch_ec2_log.ES_DOWN_WAIT = 0.1
+        self.redis_server = RedisServer()
+        self.redis = redis.StrictRedis.from_url(self.redis_server.url)
+        self.servers = [self.redis_server]
+
+    def tearDown(self):
+        es_sink.BACKOFF, fetch_ec2_log.ES_DOWN_WAIT = self.backoff, self.es_down_wait
+        for server in self.servers:
+            server.shutdown()
+
+    def _relay(self, worker_id='w1', **options):
+        return FetchLog(self.redis_server.url, KEY, reliable=True, worker_id=worker_id, **options)
+
+    def test_batches_are_acked_in_order(self):
+        self.redis.rpush(KEY, *_msgs(30))
+        sink = _Sink()
+        relay = self._relay(batch_size=10, es_sink=sink)
+        for _ in range(3):
+            relay.consume_batch()
+        processing = self.redis.lrange(relay.processing_key, 0, -1)
+        self.assertEqual((self.redis.llen(KEY), len(processing)), (0, 30))
+
+        # the second batch waits for the first one
+        sink.done[1](10, [], 0)
+        self.assertEqual(self.redis.llen(relay.processing_key), 30)
+        sink.done[0](10, [], 0)
+        self.assertEqual(self.redis.lrange(relay.processing_key, 0, -1), processing[:10])
+
+        # a batch ES failed on stays in the processing list
+        sink.done[2](0, [], 10)
+        self.assertEqual(self.redis.lrange(relay.processing_key, 0, -1), processing[:10])
+        self.assertEqual(self.redis.llen(relay.failed_key), 0)
+
+    def test_reclaims_the_list_of_a_dead_worker(self):
+        msgs = _msgs(10)
+        self.redis.rpush(KEY, *msgs)
+        dead = self._relay('dead', es_sink=_Sink())
+        dead.consume_batch()
+        self.redis.setex('%s:alive:dead' % KEY, 1, 1)
+
+        relay = self._relay(es_sink=_Sink())
+        self.assertEqual(relay.reclaim(), 0)
+        # the heartbeat expires
+        time.sleep(1.1)
+        self.assertEqual(relay.reclaim(), 10)
+        self.assertEqual(self.redis.llen(dead.processing_key), 0)
+        self.assertEqual(sorted(self.redis.lrange(KEY, 0, -1)), sorted(msgs))
+
+    def test_messages_survive_an_es_outage(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        self.redis.rpush(KEY, *(_msgs(500) + ['not json']))
+        es = Elasticsearch(['http://127.0.0.1:%d' % port], max_retries=0)
+        relay = self._relay(batch_size=100, es=es, es_sink=ESBulkSink(es, max_retries=2))
+        t = threading.Thread(target=relay.run)
+        t.daemon = True
+        t.start()
+
+        time.sleep(0.5)
+        self.assertEqual(self.redis.llen(KEY) + self.redis.llen(relay.processing_key), 501)
+        es_server = ESServer(port=port)
+        self.servers.append(es_server)
+        deadline = time.time() + 30
+        while time.time() < deadline and (self.redis.llen(KEY) or self.redis.llen(relay.processing_key)):
+            time.sleep(0.1)
+        relay.stop()
+        t.join(10)
+
+        self.assertEqual((self.redis.llen(KEY), self.redis.llen(relay.processing_key)), (0, 0))
+        self.assertEqual(self.redis.lrange(relay.failed_key, 0, -1), ['not json'])
+        self.assertTrue(es_server.docs >= 500, es_server.docs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from dedup import event_id
+from standins import FakeLogService
+
+try:
+    import fetcher
+    from remote_api_session import RemoteApiSession
+except ImportError:
+    # the GAE SDK is not installed
+    fetcher = None
+
+# an app with an environment, 10 req logs per second in 10s intervals
+APP = 'agent8-backend'
+START = 1380585600
+RATE = 10
+
+
+class _Transport(object):
+    """RedisTransports keeping the request ids of the lines it got"""
+
+    def __init__(self, fail=None):
+        self.ids = []
+        self.fail = fail
+
+    def callback(self, dest, lines):
+        if self.fail:
+            self.fail(lines)
+        self.ids.extend(line.id for line in lines)
+
+    def flush(self):
+        pass
+
+    def log_stats(self):
+        pass
+
+
+class _Checkpoints(object):
+    """CheckpointStore keeping every checkpoint it was given"""
+
+    def __init__(self):
+        self.saved = []
+
+    def set(self, key, timestamp, end=None, offset=None):
+        self.saved.append((timestamp, end, offset))
+
+    def get(self, key):
+        if self.saved:
+            return dict(zip(('timestamp', 'end', 'offset'), self.saved[-1]))
+
+    def flush(self):
+        pass
+
+    def ends(self):
+        return [timestamp for timestamp, end, offset in self.saved if offset is None]
+
+
+@unittest.skipIf(fetcher is None, "needs the GAE SDK")
+class FetchLogsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retry_wait = fetcher.RETRY_WAIT
+        fetcher.RETRY_WAIT = 0
+
+    def tearDown(self):
+        fetcher.RETRY_WAIT = self.retry_wait
+
+    def _fetcher(self, fail=None, fail_lines=None, fetch_ms=0):
+        """
+            A GAEFetchLog on a FakeLogService, whose intervals call fail
+            first and whose chunks call fail_lines before they are sent
+        """
+        service = FakeLogService(RATE, app_logs=1, fetch_ms=fetch_ms)
+
+        class LocalSession(RemoteApiSession):
+
+            def ensure(self):
+                pass
+
+            def _fetch(self, **kwargs):
+                return service.fetch(**kwargs)
+
+        gae = fetcher.GAEFetchLog(APP, 'ns', [], '127.0.0.1', 0, max_buffer_records=20, checkpoint_every=20,
+                                  redis_transports=_Transport(fail_lines), checkpoints=_Checkpoints())
+        gae.session = LocalSession(APP)
+        if fail:
+            process = gae._process_interval
+
+            def process_interval(interval, **options):
+                fail(interval)
+                return process(interval, **options)
+            gae._process_interval = process_interval
+        return gae
+
+    def _expected_ids(self, end):
+        return sorted(event_id('%016x' % i, i / float(RATE)) for i in range(START * RATE, end * RATE))
+
+    def test_out_of_order_intervals_wait_for_the_oldest(self):
+        later_done = threading.Event()
+        done = []
+
+        def fail(interval):
+            if interval[0] == START:
+                later_done.wait(5)
+        gae = self._fetcher(fail)
+        process = gae._process_interval
+
+        def process_interval(interval, **options):
+            result = process(interval, **options)
+            done.append(interval)
+            if len(done) == 2:
+                later_done.set()
+            return result
+        gae._process_interval = process_interval
+
+        gae.fetch_logs(fetcher.get_time_period(START, START + 40), workers=3)
+        self.assertTrue(later_done.is_set())
+        self.assertEqual(gae.checkpoints.ends(), [START + 10, START + 20, START + 30, START + 40])
+        # the intervals done before the first one checkpointed no offset
+        timestamps = [timestamp for timestamp, end, offset in gae.checkpoints.saved]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertEqual([offset for timestamp, end, offset in gae.checkpoints.saved
+                          if offset and timestamp in (START + 10, START + 20)], [])
+        self.assertEqual(sorted(gae.redis_transports.ids), self._expected_ids(START + 40))
+
+    def test_failed_interval_is_retried(self):
+        failures = []
+
+        def fail(interval):
+            if interval[0] == START + 10 and not failures:
+                failures.append(interval)
+                raise IOError('logservice down')
+        gae = self._fetcher(fail)
+        self.assertEqual(gae.fetch_logs(fetcher.get_time_period(START, START + 30)), 300)
+        self.assertEqual((gae.failed, len(failures)), (0, 1))
+        self.assertEqual(gae.checkpoints.ends(), [START + 10, START + 20, START + 30])
+        self.assertEqual(sorted(gae.redis_transports.ids), self._expected_ids(START + 30))
+
+    def test_retry_resumes_from_the_offset(self):
+        chunks = []
+
+        def fail_lines(lines):
+            if START + 10 <= lines[0].end_time < START + 20:
+                chunks.append(lines)
+                if len(chunks) == 3:
+                    raise IOError('redis down')
+        # a round trip per chunk, the sink has sent it before the next one
+        gae = self._fetcher(fail_lines=fail_lines, fetch_ms=20)
+        self.assertEqual(gae.fetch_logs(fetcher.get_time_period(START, START + 30)), 300)
+        self.assertEqual(gae.failed, 0)
+        self.assertTrue([offset for timestamp, end, offset in gae.checkpoints.saved
+                         if offset and timestamp == START + 10])
+        # the first chunk of the interval was not sent again
+        ids = gae.redis_transports.ids
+        self.assertEqual(ids.count(chunks[0][0].id), 1)
+        self.assertEqual(sorted(set(ids)), self._expected_ids(START + 30))
+
+    def test_stops_at_the_last_committed_interval(self):
+        def fail(interval):
+            if interval[0] == START + 10:
+                raise IOError('logservice down')
+        gae = self._fetcher(fail)
+        gae.fetch_logs(fetcher.get_time_period(START, START + 40), workers=3)
+        self.assertEqual(gae.failed, 1)
+        self.assertEqual(gae.checkpoints.ends(), [START + 10])
+        self.assertEqual(max(timestamp for timestamp, end, offset in gae.checkpoints.saved), START + 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+import metrics
+from filters import LEVELS, RequestFilter, read_filters
+
+
+class _ReqLog(object):
+
+    def __init__(self, request_id, resource='/api/items', status=200):
+        self.request_id = request_id
+        self.resource = resource
+        self.status = status
+
+
+class _AppLog(object):
+
+    def __init__(self, level):
+        self.level = level
+
+
+class RequestFilterTest(unittest.TestCase):
+
+    def test_keeps_everything_by_default(self):
+        request_filter = RequestFilter('app')
+        self.assertTrue(request_filter.keep(_ReqLog('a', '/_ah/health', 500)))
+        self.assertEqual(request_filter.minimum_log_level, LEVELS['info'])
+        self.assertTrue(request_filter.include_app_logs())
+
+    def test_path_and_status_rules(self):
+        request_filter = RequestFilter('app', include_path='^/api/', exclude_path='^/api/ping',
+                                       exclude_status='^3')
+        self.assertTrue(request_filter.keep(_ReqLog('a', '/api/items', 200)))
+        self.assertFalse(request_filter.keep(_ReqLog('b', '/static/app.js', 200)))
+        self.assertFalse(request_filter.keep(_ReqLog('c', '/api/ping', 200)))
+        self.assertFalse(request_filter.keep(_ReqLog('d', '/api/items', 302)))
+        dropped = request_filter.dropped()
+        self.assertEqual((dropped['include_path'], dropped['exclude_path'], dropped['exclude_status']), (1, 1, 1))
+
+    def test_sampling_is_stable(self):
+        request_filter = RequestFilter('app', sample_rate='0.1')
+        req_logs = [_ReqLog('%016x' % i) for i in range(10000)]
+        kept = [req_log.request_id for req_log in req_logs if request_filter.keep(req_log)]
+        self.assertTrue(800 < len(kept) < 1200, len(kept))
+        self.assertEqual(kept, [req_log.request_id for req_log in req_logs if request_filter.keep(req_log)])
+
+    def test_sample_path(self):
+        request_filter = RequestFilter('app', sample_rate=0, sample_path='^/_ah/')
+        self.assertFalse(request_filter.keep(_ReqLog('a', '/_ah/health')))
+        self.assertTrue(request_filter.keep(_ReqLog('b', '/api/items')))
+
+    def test_app_log_level(self):
+        request_filter = RequestFilter('app', app_log_level='warning')
+        app_logs = [_AppLog(level) for level in range(5)]
+        self.assertEqual(request_filter.app_logs(app_logs), app_logs[2:])
+        self.assertEqual(request_filter.dropped()['app_log_level'], 2)
+        self.assertFalse(RequestFilter('app', app_log_level='none').include_app_logs())
+
+    def test_levels(self):
+        self.assertEqual(RequestFilter('app', minimum_log_level='WARNING').minimum_log_level, LEVELS['warning'])
+        self.assertRaises(ValueError, RequestFilter, 'app', minimum_log_level='warn')
+        self.assertRaises(ValueError, RequestFilter, 'app', app_log_level='verbose')
+
+    def test_counts_what_it_dropped(self):
+        request_filter = RequestFilter('counted', exclude_path='^/_ah/')
+        for _ in range(3):
+            request_filter.keep(_ReqLog('a', '/_ah/health'))
+        self.assertIn('filtered_total{app="counted",rule="exclude_path"} 3', metrics.REGISTRY.render())
+
+
+class ReadFiltersTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.conf = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.conf)
+
+    def _write(self, text):
+        with open(self.conf, 'w') as f:
+            f.write(text)
+
+    def test_no_section(self):
+        self._write('[GAE]\napp_name = app\n')
+        self.assertEqual(read_filters(self.conf, 'app'), None)
+
+    def test_app_overrides(self):
+        self._write('[FILTERS]\nminimum_log_level = warning\nminimum_log_level.other = error\n'
+                    'exclude_path = ^/_ah/\n')
+        request_filter = read_filters(self.conf, 'app')
+        self.assertEqual(request_filter.minimum_log_level, LEVELS['warning'])
+        self.assertFalse(request_filter.keep(_ReqLog('a', '/_ah/health')))
+        self.assertEqual(read_filters(self.conf, 'other').minimum_log_level, LEVELS['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from datetime import datetime
+
+from record import LogRecord
+
+RECORDS = [
+    LogRecord('app-gae', '2013-10-01T00:00:00.500000-07:00',
+              '10.0.0.1 - - "GET /caf\xe9 HTTP/1.1" 200\n\n2013-10-01T00:00:00.400000-07:00 INFO \xe9t\xe9',
+              200, 0.0125, 1380610800.5, 'production'),
+    LogRecord('app-gae', '2013-10-01T00:00:01-07:00', u'GET /api ☃', 500, 1.5, 1380610801.0, 'staging',
+              id='00000001-1380610801000000'),
+]
+
+# what serializer.EventEncoder and the logcenter formatter of
+# BaseTransport made of RECORDS, before LogRecord encoded them itself
+RAW = [
+    r'{"@type": "app-gae", "@tags": ["gae"], "@timestamp": "2013-10-01T00:00:00.500000-07:00", "@fields": '
+    r'{"environment": "production", "timestamp": 1380610800.5, "response": 200, "latency_ms": 0.0125}, '
+    r'"@message": "10.0.0.1 - - \"GET /caf\u00e9 HTTP/1.1\" 200\n\n2013-10-01T00:00:00.400000-07:00 INFO '
+    r'\u00e9t\u00e9"}',
+    r'{"@type": "app-gae", "@tags": ["gae"], "@timestamp": "2013-10-01T00:00:01-07:00", "@fields": '
+    r'{"environment": "staging", "timestamp": 1380610801.0, "event_id": "00000001-1380610801000000", '
+    r'"response": 500, "latency_ms": 1.5}, "@message": "GET /api \u2603"}',
+]
+LOGCENTER = [
+    r'{"@fields": {"instance_id": "gae", "hour": ["07"], "latency_ms": 0.0125, "timestamp": 1380610800.5, '
+    r'"level": ["INFO"], "component": "gae", "log_line": [0], "environment": "production", "type": "app-gae", '
+    r'"date": ["2013-10-01"], "log_source": ["gae"], "instance_name": "gae", "response": 200}, '
+    r'"@timestamp": "2013-10-01T00:00:00.500000-07:00", "@type": "app-gae", "@tags": ["gae"], '
+    r'"@message": "10.0.0.1 - - \"GET /caf\u00e9 HTTP/1.1\" 200\n\n2013-10-01T00:00:00.400000-07:00 INFO '
+    r'\u00e9t\u00e9"}',
+    r'{"@fields": {"instance_id": "gae", "hour": ["07"], "latency_ms": 1.5, '
+    r'"event_id": "00000001-1380610801000000", "timestamp": 1380610801.0, "level": ["INFO"], '
+    r'"component": "gae", "log_line": [0], "environment": "staging", "type": "app-gae", '
+    r'"date": ["2013-10-01"], "log_source": ["gae"], "instance_name": "gae", "response": 500}, '
+    r'"@timestamp": "2013-10-01T00:00:01-07:00", "@type": "app-gae", "@tags": ["gae"], '
+    r'"@message": "GET /api \u2603"}',
+]
+
+
+class LogRecordTest(unittest.TestCase):
+
+    def test_raw_and_source(self):
+        for record, raw in zip(RECORDS, RAW):
+            self.assertEqual(json.loads(record.raw()), json.loads(raw))
+            self.assertEqual(record.source(), record.raw())
+
+    def test_logcenter(self):
+        for record, logcenter in zip(RECORDS, LOGCENTER):
+            expected = json.loads(logcenter)
+            # the golden events were made in UTC, dates and hours are local
+            log_time = datetime.fromtimestamp(record.end_time)
+            expected['@fields']['date'] = [log_time.strftime('%Y-%m-%d')]
+            expected['@fields']['hour'] = ['%02d' % log_time.hour]
+            self.assertEqual(json.loads(record.logcenter()), expected)
+
+    def test_from_event(self):
+        for record in RECORDS:
+            self.assertEqual(LogRecord.from_event(json.loads(record.raw())).raw(), record.raw())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import unittest
+
+import redis
+
+from record import LogRecord
+from redis_transport import RedisTransports
+from standins import RedisServer
+
+
+def _lines(n):
+    return [LogRecord('app-gae', '2013-10-01T00:00:00', 'line %d' % i, 200, 10, 1380610800 + i, 'production')
+            for i in range(n)]
+
+
+class RedisTransportsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [RedisServer(), RedisServer()]
+        # 10 messages per RPUSH, 2 RPUSH per round trip
+        self.transports = RedisTransports('ns', [server.url for server in self.servers], 'test',
+                                          logger=logging.getLogger(), backoff=0.2, es_options={'workers': 0},
+                                          rpush_max_count=10, max_in_flight=2)
+        self.pushed = [redis.StrictRedis.from_url(server.url) for server in self.servers]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+
+    def _fail_third_round(self):
+        """The third round trip of any backend fails before it is sent"""
+        rounds = []
+        for trans in self.transports._trans:
+            def execute(trans=trans, execute=trans._execute):
+                rounds.append(trans)
+                if len(rounds) == 3:
+                    trans._pipeline.reset()
+                    raise redis.exceptions.ConnectionError('connection lost')
+                execute()
+            trans._execute = execute
+        return rounds
+
+    def test_only_the_unsent_tail_fails_over(self):
+        rounds = self._fail_third_round()
+        lines = _lines(100)
+        self.transports.callback('app-2013-10-01.log', lines)
+
+        failed = self.transports._trans.index(rounds[0])
+        pushed = [r.lrange('ns', 0, -1) for r in self.pushed]
+        self.assertEqual(len(pushed[failed]), 40)
+        self.assertEqual(len(pushed[1 - failed]), 60)
+        self.assertEqual(pushed[failed] + pushed[1 - failed], [line.raw() for line in lines])
+
+    def test_ejected_backend_is_probed_and_readmitted(self):
+        rounds = self._fail_third_round()
+        self.transports.callback('app-2013-10-01.log', _lines(100))
+        failed = self.transports._trans.index(rounds[0])
+        health, other = self.transports._health[failed], self.transports._health[1 - failed]
+
+        self.assertTrue(health.stats()['ejected'])
+        for _ in range(10):
+            self.assertEqual(self.transports._choose([]), other)
+
+        # pinged once the back-off is over
+        time.sleep(0.25)
+        self.assertEqual(self.transports._choose([other]), health)
+        self.assertTrue(health.trans.valid())
+        health.trans.push(['{"@message": "back"}'])
+        self.assertEqual(self.pushed[failed].lrange('ns', -1, -1), ['{"@message": "back"}'])
+
+    def test_failed_probe_ejects_for_longer(self):
+        health = self.transports._health[0]
+        health.failure(self.transports.backoff, self.transports.max_backoff)
+        health.trans.invalidate()
+        self.servers[0].shutdown()
+
+        time.sleep(0.25)
+        self.assertFalse(self.transports._available(health))
+        self.assertEqual(health.failures, 2)
+        self.assertTrue(health.ejected_until - time.time() > 0.3)
+        self.assertEqual(self.transports._choose([]), self.transports._health[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import logging
+import shutil
+import tempfile
+import unittest
+
+from archive import ArchiveWriter
+from record import LogRecord
+from redis_transport import RedisTransports
+from replay import replay
+from standins import ESServer, RedisServer
+
+START = 1380610800
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        writer = ArchiveWriter(self.directory)
+        writer.write_lines('app-2013-10-01.log', [
+            LogRecord('app-gae', '2013-10-01T00:00:%02d' % i, 'line %d' % i, 200, 10, START + i, 'production',
+                      id='req%d' % i)
+            for i in range(50)])
+        writer.close()
+        self.servers = [RedisServer()]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.directory)
+
+    def _replay(self, **options):
+        es_server = ESServer(**options)
+        self.servers.append(es_server)
+        redis_transports = RedisTransports('ns', [self.servers[0].url], 'test', logger=logging.getLogger(),
+                                           es_options={'hosts': [es_server.url]})
+        return replay(self.directory, ['app'], START, START + 3600, redis_transports, send_to_es=True,
+                      chunk_records=20), es_server
+
+    def test_sends_to_es(self):
+        (records, failed), es_server = self._replay()
+        self.assertEqual((records, failed), (50, 0))
+        self.assertEqual(es_server.docs, 50)
+
+    def test_counts_the_docs_es_dropped(self):
+        (records, failed), es_server = self._replay(drop_rate=1)
+        self.assertEqual((records, failed), (50, 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
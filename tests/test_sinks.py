@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+
+from sinks import Delivery, SinkFanout
+
+
+class SinkFanoutTest(unittest.TestCase):
+
+    def test_each_sink_sees_its_batches_in_order(self):
+        sinks = SinkFanout(queue_size=2)
+        got = {'a': [], 'b': []}
+        for i in range(20):
+            sinks.deliver('a', got['a'].append, i)
+            sinks.deliver('b', got['b'].append, i)
+        sinks.flush()
+        self.assertEqual(got, {'a': range(20), 'b': range(20)})
+
+    def test_delivery_done_once_every_sink_ran(self):
+        sinks = SinkFanout()
+        release = threading.Event()
+        sent = []
+        delivery = Delivery(lambda: sent.append(1))
+        sinks.deliver('fast', lambda: None, delivery=delivery)
+        sinks.deliver('slow', release.wait, delivery=delivery)
+        delivery.seal()
+        self.assertFalse(delivery.done.wait(0.1))
+        release.set()
+        self.assertTrue(delivery.done.wait(5))
+        self.assertEqual((delivery.failed, sent), (0, [1]))
+
+    def test_failed_sink_fails_the_delivery(self):
+        sinks = SinkFanout()
+        sent = []
+        delivery = Delivery(lambda: sent.append(1))
+
+        def fail():
+            raise IOError('redis down')
+        sinks.deliver('ok', lambda: None, delivery=delivery)
+        sinks.deliver('broken', fail, delivery=delivery)
+        delivery.seal()
+        self.assertTrue(delivery.done.wait(5))
+        self.assertEqual((delivery.failed, sent), (1, []))
+        self.assertEqual(sinks.errors(), 1)
+
+    def test_held_delivery(self):
+        delivery = Delivery()
+        release = delivery.hold()
+        delivery.seal()
+        self.assertFalse(delivery.done.is_set())
+        release(False)
+        self.assertTrue(delivery.done.is_set())
+        self.assertEqual(delivery.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+from datetime import datetime, timedelta, tzinfo
+
+from timefmt import TimeFormatter
+
+
+class _Offset(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(hours=-7)
+
+    def dst(self, dt):
+        return timedelta(0)
+
+
+class TimeFormatterTest(unittest.TestCase):
+
+    def _timestamps(self):
+        rnd = random.Random(1)
+        timestamps = [1380610800, 1380610800.5, 1380610800.9999996, 1380610800.000001]
+        timestamps += [1380610800 + rnd.random() * 86400 * 30 for _ in range(1000)]
+        # several per second, as the cache sees them
+        timestamps += [1380610800 + i / 7.0 for i in range(1000)]
+        return timestamps
+
+    def test_isoformat(self):
+        for tz in (None, _Offset()):
+            times = TimeFormatter(tz, size=16)
+            for timestamp in self._timestamps():
+                self.assertEqual(times.isoformat(timestamp),
+                                 datetime.fromtimestamp(timestamp).replace(tzinfo=tz).isoformat())
+
+    def test_date_hour(self):
+        times = TimeFormatter(size=16)
+        for timestamp in self._timestamps():
+            log_time = datetime.fromtimestamp(timestamp)
+            self.assertEqual(times.date_hour(timestamp), (log_time.strftime('%Y-%m-%d'), '%02d' % log_time.hour))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+# entries kept by each cache before it is emptied
+CACHE_SIZE = 4096
+
+# every UTC offset in use is a multiple of 15 minutes, so local dates and
+# hours only change on these boundaries
+QUARTER_HOUR = 15 * 60
+
+
+class TimeFormatter(object):
+    """
+        Renders log timestamps like datetime.fromtimestamp would, caching
+        the part of the ISO string that only changes every second and the
+        local date and hour, which only change every quarter hour
+    """
+
+    def __init__(self, tzinfo=None, size=CACHE_SIZE):
+        self.tzinfo = tzinfo
+        self.size = size
+        self._seconds = {}
+        self._hours = {}
+
+    def isoformat(self, timestamp):
+        """
+            Same as datetime.fromtimestamp(timestamp).replace(tzinfo=tzinfo).isoformat()
+        """
+        second = int(timestamp // 1)
+        us = int(round((timestamp - second) * 1e6))
+        if us >= 1000000:
+            second += 1
+            us -= 1000000
+
+        parts = self._seconds.get(second)
+        if parts is None:
+            if len(self._seconds) >= self.size:
+                self._seconds.clear()
+            iso = datetime.fromtimestamp(second).replace(tzinfo=self.tzinfo).isoformat()
+            parts = self._seconds[second] = (iso[:19], iso[19:])
+
+        if us:
+            return '%s.%06d%s' % (parts[0], us, parts[1])
+        return parts[0] + parts[1]
+
+    def date_hour(self, timestamp):
+        """Returns the local ('%Y-%m-%d', '%02d' hour) of timestamp"""
+        quarter = int(timestamp // QUARTER_HOUR)
+        parts = self._hours.get(quarter)
+        if parts is None:
+            if len(self._hours) >= self.size:
+                self._hours.clear()
+            log_time = datetime.fromtimestamp(quarter * QUARTER_HOUR)
+            parts = self._hours[quarter] = (log_time.strftime('%Y-%m-%d'), '%02d' % log_time.hour)
+        return parts